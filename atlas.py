@@ -0,0 +1,148 @@
+import json
+import os
+import sys
+
+import pygame
+
+# Сборка всех картинок data/sprites в один атлас: atlas.bmp и индекс atlas.json
+# (логическое имя -> прямоугольник, сетка кадров, время изменения и размер исходника).
+# Игра читает атлас один раз и раздает части его картинки по имени, а не открывает
+# каждый файл. Атлас хранится несжатым BMP: он в разы больше PNG, но читается без распаковки.
+# Имена всегда через '/', поэтому одинаковы на всех системах.
+# Картинка, которой нет в атласе или которая изменилась после сборки, читается из своего файла.
+#
+#   python atlas.py
+
+SPRITE_DIR = os.path.join('data', 'sprites')
+ATLAS_DIR = os.path.join(SPRITE_DIR, 'atlas')
+ATLAS_IMAGE = os.path.join(ATLAS_DIR, 'atlas.bmp')
+ATLAS_INDEX = os.path.join(ATLAS_DIR, 'atlas.json')
+VERSION = 1
+ATLAS_WIDTHS = range(0, 4097, 64)  # Ширины атласа на пробу, берется та, где меньше пустого места
+SHEET_GRIDS = {'characters/Jods.png': (22, 1), 'characters/enemy.png': (2, 3), 'flag.png': (1, 3)}  # Листы кадров
+
+
+def logical_name(name):
+    # 'blocks\\block1.png' и 'blocks/block1.png' - одно имя
+    return '/'.join(part for part in name.replace('\\', '/').split('/') if part)
+
+
+def sprite_names():
+    names = list()
+    for folder, dirs, files in os.walk(SPRITE_DIR):
+        dirs[:] = sorted(name for name in dirs if os.path.join(folder, name) != ATLAS_DIR)
+        relative = os.path.relpath(folder, SPRITE_DIR)
+        for name in sorted(files):
+            if name.lower().endswith('.png'):
+                names.append(logical_name(name if relative == '.' else os.path.join(relative, name)))
+    return names
+
+
+def pack(sizes, width):
+    # Полки: картинки от высоких к низким, каждая - на первую полку, где хватает места справа
+    shelves = list()  # [верх, высота, занятая ширина]
+    places = dict()
+    height = 0
+    for name in sorted(sizes, key=lambda name: (-sizes[name][1], -sizes[name][0], name)):
+        w, h = sizes[name]
+        for shelf in shelves:
+            if h <= shelf[1] and shelf[2] + w <= width:
+                break
+        else:
+            shelf = [height, h, 0]
+            shelves.append(shelf)
+            height += h
+        places[name] = (shelf[2], shelf[0])
+        shelf[2] += w
+    return places, height
+
+
+def build():
+    # Нужен дисплей: картинки приводятся к тому же формату, что дает convert_alpha в игре
+    images = dict()
+    sources = dict()
+    for name in sprite_names():
+        path = os.path.join(SPRITE_DIR, *name.split('/'))
+        images[name] = pygame.image.load(path).convert_alpha()
+        stat = os.stat(path)
+        sources[name] = (stat.st_mtime_ns, stat.st_size)
+    sizes = {name: image.get_size() for name, image in images.items()}
+    widest = max([1] + [w for w, h in sizes.values()])
+    layouts = [(pack(sizes, width), width) for width in [widest] + [w for w in ATLAS_WIDTHS if w > widest]]
+    (places, height), width = min(layouts, key=lambda layout: layout[0][1] * layout[1])
+    atlas = pygame.Surface((width, max(height, 1)), pygame.SRCALPHA, 32)
+    atlas.fill((0, 0, 0, 0))
+    sprites = dict()
+    for name, image in images.items():
+        atlas.blit(image, places[name], special_flags=pygame.BLEND_RGBA_ADD)  # На прозрачный ноль - точная копия
+        sprites[name] = {'rect': list(places[name]) + list(sizes[name]), 'grid': SHEET_GRIDS.get(name, (1, 1)),
+                         'mtime': sources[name][0], 'bytes': sources[name][1]}
+    os.makedirs(ATLAS_DIR, exist_ok=True)
+    pygame.image.save(atlas, ATLAS_IMAGE)
+    with open(ATLAS_INDEX, mode='w') as file:
+        json.dump({'version': VERSION, 'size': [width, height], 'sprites': sprites}, file, indent=1)
+    return sprites, (width, height)
+
+
+class Atlas:
+    def __init__(self, image, sprites):
+        self.image = image
+        self.sprites = sprites  # Имя -> запись индекса
+        self.frames = dict()  # Имя -> часть картинки атласа
+
+    def get(self, name):
+        # Часть атласа с картинкой name или None, если ее в атласе нет
+        name = logical_name(name)
+        frame = self.frames.get(name)
+        if frame is None and name in self.sprites:
+            frame = self.image.subsurface(pygame.Rect(self.sprites[name]['rect']))
+            self.frames[name] = frame
+        return frame
+
+
+def atlas_index():
+    # Записи индекса, чьи исходники не менялись после сборки, или None, если атлас не собран
+    try:
+        with open(ATLAS_INDEX) as file:
+            index = json.load(file)
+        if index.get('version') != VERSION:
+            return None
+        sprites = dict()
+        for name, entry in index['sprites'].items():
+            try:
+                stat = os.stat(os.path.join(SPRITE_DIR, *name.split('/')))
+            except OSError:
+                continue
+            if stat.st_mtime_ns == entry['mtime'] and stat.st_size == entry['bytes']:
+                sprites[name] = entry
+    except (OSError, ValueError, KeyError):
+        return None
+    return sprites or None
+
+
+def atlas_load(sprites=None, convert=True):
+    # Атлас из ATLAS_DIR или None, если он не собран. Записи, чьи исходники изменились, пропускаются.
+    # convert=False - картинка остается как прочитана (convert_alpha нужен дисплей, а так можно звать из потока)
+    if sprites is None:
+        sprites = atlas_index()
+        if sprites is None:
+            return None
+    try:
+        image = pygame.image.load(ATLAS_IMAGE)
+    except (OSError, pygame.error):
+        return None
+    if convert and pygame.display.get_surface() is not None:
+        image = image.convert_alpha()
+    return Atlas(image, sprites)
+
+
+def main():
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    pygame.init()
+    pygame.display.set_mode((1, 1))
+    sprites, size = build()
+    print('{0}: {1} картинок, {2}x{3}'.format(ATLAS_IMAGE, len(sprites), size[0], size[1]))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
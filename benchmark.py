@@ -0,0 +1,273 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+from collections import defaultdict
+from time import perf_counter
+
+import pygame
+
+import game
+
+# Замер производительности игрового цикла без окна.
+# Каждый уровень из LEVEL_LIST и синтетические тяжелые уровни прогоняются N кадров
+# по одной и той же последовательности нажатий, время считается по фазам кадра.
+# Результат пишется в JSON; если указан --baseline, замедление фаз сверх допуска - ошибка.
+#
+#   python benchmark.py --frames 3000 --output new.json --baseline old.json
+
+PHASES = ('collide_detect', 'player_move', 'enemy_move', 'animation', 'draw', 'step')
+
+
+class PhaseTimer:
+    # Подменяет функции и методы обертками, которые копят время вызовов по фазам.
+    # collide_detect вызывается изнутри move, поэтому его время входит и в player_move/enemy_move
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.patches = list()
+
+    def wrap(self, owner, attr, phase):
+        original = owner.__dict__[attr] if isinstance(owner, type) else getattr(owner, attr)
+        totals = self.totals
+        calls = self.calls
+
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                totals[phase] += perf_counter() - start
+                calls[phase] += 1
+        setattr(owner, attr, timed)
+        self.patches.append((owner, attr, original))
+
+    def install(self):
+        self.wrap(game, 'collide_detect', 'collide_detect')
+        self.wrap(game.Player, 'move', 'player_move')
+        self.wrap(game.Enemy, 'move', 'enemy_move')
+        self.wrap(game.World, 'swarm_step', 'enemy_move')
+        for owner in (game.Player, game.Enemy):
+            self.wrap(owner, 'sprite_change', 'animation')
+        for owner in (game.AnimatedSprite, game.Player):
+            self.wrap(owner, 'update', 'animation')
+        self.wrap(game.World, 'draw', 'draw')
+        self.wrap(game.World, 'step', 'step')
+
+    def restore(self):
+        for owner, attr, original in reversed(self.patches):
+            setattr(owner, attr, original)
+        self.patches.clear()
+
+    def reset(self):
+        self.totals.clear()
+        self.calls.clear()
+
+
+def scripted_trace(seed, frames):
+    # Куски бега влево/вправо/стояния случайной длины, прыжки время от времени
+    rng = random.Random(seed)
+    direction = list()
+    left = 0
+    for frame in range(frames):
+        if left == 0:
+            direction = rng.choice([['right'], ['right'], ['left'], []])
+            left = rng.randint(20, 120)
+        left -= 1
+        yield direction, rng.random() < 0.04
+
+
+def recorded_trace(path, frames):
+    # JSON-список пар [направление, прыжок], например [["right"], false]; повторяется по кругу
+    with open(path) as file:
+        inputs = [(list(direction), bool(jump)) for direction, jump in json.load(file)]
+    for frame in range(frames):
+        yield inputs[frame % len(inputs)]
+
+
+def synth_grid(cols, rows, gap, rng):
+    # Стены по краям, пол и случайные платформы через каждые gap строк
+    grid = [['#'] * cols for row in range(rows)]
+    floor = min(rows - 1, game.HEIGHT // 32 - 1)  # Пол в пределах первого экрана, на нем появляется игрок
+    for col in range(cols):
+        grid[rows - 1][col] = '1'
+        grid[floor][col] = '1'
+    for row in range(rows - 1 - gap, 3, -gap):
+        col = rng.randint(0, 6)
+        while col < cols:
+            length = rng.randint(4, 12)
+            for c in range(col, min(col + length, cols)):
+                grid[row][c] = rng.choice('123456')
+            col += length + rng.randint(2, 6)
+    for row in range(rows):  # Стены, чтобы враги не уходили с уровня
+        grid[row][0] = grid[row][cols - 1] = '1'
+    grid[floor - 2][1] = 'J'
+    return grid
+
+
+def synth_level(path, cols, rows, enemies, spikes, seed):
+    # Уровень-нагрузка: враги и шипы на свободных местах, ничто ни с чем не пересекается.
+    # Враг шириной в два тайла занимает свою клетку и клетку справа. Шипы и первые враги стоят
+    # на платформах, остальные плотно заполняют пустые клетки по порядку и падают на платформы.
+    # Если опор для шипов не хватает, платформы идут чаще
+    for gap in (4, 3, 2):
+        rng = random.Random(seed)
+        grid = synth_grid(cols, rows, gap, rng)
+        spots = [(col, row) for row in range(1, rows - 1) for col in range(3, cols - 1)
+                 if grid[row][col] == '#' and grid[row][col + 1] == '#' and grid[row + 1][col] in '123456']
+        if len(spots) >= spikes:
+            break
+    else:
+        raise ValueError('{0}: мест для шипов {1}, нужно {2}'.format(path, len(spots), spikes))
+    rng.shuffle(spots)
+    taken = set()  # Клетки, занятые шипами и врагами
+    for col, row in spots[:spikes]:
+        grid[row][col] = 's'
+        taken.add((col, row))
+    rest = [(col, row) for row in range(1, rows - 1) for col in range(3, cols - 2)]  # По порядку - враги встают плотно
+    placed = list()
+    for col, row in spots[spikes:] + rest:
+        if len(placed) == enemies:
+            break
+        cells = ((col, row), (col + 1, row))
+        if all(grid[r][c] == '#' and (c, r) not in taken for c, r in cells):
+            grid[row][col] = 'e'
+            taken.update(cells)
+            placed.append((col, row))
+    if len(placed) < enemies:
+        raise ValueError('{0}: мест для врагов {1}, нужно {2}'.format(path, len(placed), enemies))
+    covered = defaultdict(int)  # Проверка готовой сетки: клетка -> сколько шипов и врагов ее занимают
+    for row in range(rows):
+        for col in range(cols):
+            if grid[row][col] == 's':
+                covered[(col, row)] += 1
+            elif grid[row][col] == 'e':
+                covered[(col, row)] += 1
+                covered[(col + 1, row)] += 1
+    for (col, row), count in covered.items():
+        if count > 1 or grid[row][col] not in '#se':
+            raise ValueError('{0}: в клетке {1} враг задевает блок или другой объект'.format(path, (col, row)))
+    with open(path, mode='w') as file:
+        file.write('\n'.join(''.join(row) for row in grid))
+    return path
+
+
+def stress_levels(directory, seed):
+    # Имена уровней - абсолютные пути, поэтому компилятор уровней читает их не из data/levels
+    return {
+        'stress_enemies': synth_level(os.path.join(directory, 'stress_enemies.txt'), 40, 23, 250, 10, seed),
+        'stress_spikes': synth_level(os.path.join(directory, 'stress_spikes.txt'), 40, 23, 20, 200, seed),
+        'stress_large': synth_level(os.path.join(directory, 'stress_large.txt'), 160, 92, 400, 300, seed),
+    }
+
+
+def level_objects(name):
+    # Сколько врагов и шипов на уровне на самом деле, по скомпилированному уровню
+    symbols = [symbol for symbol, col, row in game.compiled_level_load(name).entities]
+    return {'enemies': symbols.count('e') + symbols.count('c'), 'spikes': symbols.count('s')}
+
+
+def run_level(timer, name, inputs, frames, seed, canvas, swarm=False):
+    world = game.World(seed=seed, level=name, swarm=swarm)
+    world.draw(canvas, True)  # Запекание фона - не часть кадра
+    timer.reset()
+    start = perf_counter()
+    done = 0
+    restarts = 0
+    restart_time = 0
+    for direction, jump in inputs:
+        if world.step(direction, jump) is not None:  # Смерть или победа - уровень сначала
+            restart_start = perf_counter()
+            world.close()
+            world = game.World(seed=seed, level=name, swarm=swarm)
+            restarts += 1
+            restart_time += perf_counter() - restart_start
+        world.draw(canvas)
+        done += 1
+        if done >= frames:
+            break
+    elapsed = perf_counter() - start - restart_time
+    enemies_left = None  # Сколько врагов не упало с уровня; на больших уровнях часть их спит в выгруженных кусках
+    if not world.level_scene.chunked:
+        enemies_left = sum(1 for enemy in world.enemies if enemy.rect.top < world.level_scene.height)
+    world.close()
+    phases = {phase: {'calls': timer.calls[phase], 'total_ms': round(timer.totals[phase] * 1000, 3),
+                      'per_frame_us': round(timer.totals[phase] * 1e6 / max(done, 1), 3)}
+              for phase in PHASES}
+    return {'frames': done, 'objects': dict(level_objects(name), enemies_left=enemies_left),
+            'restarts': restarts, 'restart_ms': round(restart_time * 1000, 3),
+            'frame_us': round(elapsed * 1e6 / max(done, 1), 3), 'phases': phases}
+
+
+def compare(results, baseline, tolerance):
+    regressions = list()
+    for variant, old in baseline.get('results', {}).items():
+        new = results.get(variant)
+        if new is None:
+            continue
+        for phase, old_phase in old['phases'].items():
+            before = old_phase['per_frame_us']
+            after = new['phases'].get(phase, {}).get('per_frame_us', 0)
+            if after > before * (1 + tolerance) and after - before > 1:
+                regressions.append('{0}/{1}: {2:.1f} -> {3:.1f} мкс на кадр'.format(variant, phase, before, after))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Замер производительности игрового цикла')
+    parser.add_argument('--frames', type=int, default=2000, help='кадров на уровень')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--levels', nargs='*', default=None, help='уровни (по умолчанию все из LEVEL_LIST)')
+    parser.add_argument('--no-stress', action='store_true', help='без синтетических тяжелых уровней')
+    parser.add_argument('--swarm', action='store_true', help='враги массивами NumPy (EnemySwarm)')
+    parser.add_argument('--trace', default=None, help='JSON с записанными нажатиями вместо сценария')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=None, help='JSON прошлого замера для сравнения')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='допустимое замедление фазы (0.2 = 20%%)')
+    args = parser.parse_args(argv)
+
+    game.headless_init()
+    canvas = pygame.display.get_surface()
+    levels = {name: name for name in (args.levels or game.LEVEL_LIST)}
+    timer = PhaseTimer()
+    results = dict()
+    with tempfile.TemporaryDirectory(prefix='jods_bench_') as directory:
+        if not args.no_stress:
+            levels.update(stress_levels(directory, args.seed))
+        timer.install()
+        try:
+            for variant, name in levels.items():
+                if args.trace:
+                    inputs = recorded_trace(args.trace, args.frames)
+                else:
+                    inputs = scripted_trace(args.seed, args.frames)
+                results[variant] = run_level(timer, name, inputs, args.frames, args.seed, canvas, args.swarm)
+                result = results[variant]
+                print('{0:16} {1:9.1f} мкс/кадр  step {2:9.1f}  draw {3:8.1f}  врагов {4:4}  шипов {5:4}'.format(
+                      variant, result['frame_us'], result['phases']['step']['per_frame_us'],
+                      result['phases']['draw']['per_frame_us'], result['objects']['enemies'],
+                      result['objects']['spikes']))
+        finally:
+            timer.restore()
+
+    report = {'meta': {'frames': args.frames, 'seed': args.seed, 'trace': args.trace, 'swarm': args.swarm,
+                       'python': platform.python_version(), 'pygame': pygame.version.ver,
+                       'machine': platform.machine()},
+              'results': results}
+    with open(args.output, mode='w') as file:
+        json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for line in regressions:
+            print('Замедление: ' + line)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
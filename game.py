@@ -1,69 +1,368 @@
 import pygame
 import os
-from random import randint
+import argparse
+import csv
+import json
+import random
+import threading
+from collections import OrderedDict, deque, namedtuple
+from time import perf_counter_ns
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from atlas import atlas_index, atlas_load, logical_name
+from memory import MemoryTracker, diff_report
+from recording import Recorder
+from level_compiler import compiled_level_load, merge_solids, ENTITY_TILES, SOLID_TILES, SYMBOLS, TILE_IDS
+from navigation import NavGraph, JUMP_DY, TILE
+try:
+    from swarm import EnemySwarm
+except ImportError:  # Нет NumPy - враги считаются только по одному
+    EnemySwarm = None
 
 WIDTH = 1280
 HEIGHT = 720
 SIZE = WIDTH, HEIGHT
-FPS = 60
+FPS = 60  # Предел кадров отрисовки в секунду, 0 - без предела
+PHYSICS_RATE = 60  # Шагов физики в секунду, не зависит от частоты отрисовки
+BASE_RATE = 60  # Частота шагов, под которую подобраны все скорости и ускорения
+ANIMATION_STEPS = 8  # Кадр анимации сменяется раз в столько шагов при BASE_RATE
+MAX_STEPS = 5  # Больше шагов физики за один кадр не догоняем, иначе игра замедлится
 LEVEL_LIST = ['level1.txt', 'level2.txt', 'level3.txt', 'level4.txt', 'level5.txt', 'level6.txt']
-CURRENT_LEVEL = 'level1.txt'
+START_LEVEL = 'level1.txt'  # С него начинается новая игра
+ASSET_CACHE_LIMIT = 64 * 1024 * 1024  # Предел кэша ресурсов в байтах
+GRID_CELL = 32  # Размер клетки сетки столкновений (равен размеру тайла)
+MASK_STEP = 8  # Шаг в пикселях, с которым маски проверяются вдоль сдвига через шипы и врагов
+RNG = random.Random()  # Для врагов, созданных вне World; у World у каждого уровня свой генератор (level_rng)
+MUTED = False  # Без звука: в безголовом режиме звуки не проигрываются
+BACKGROUND_COLOR = (70, 70, 170)
+FULL_FLIP = False  # True - каждый кадр выводится весь экран, False - только изменившиеся прямоугольники
+LEVEL_LAYERS = dict()  # Имя уровня -> картинка с фоном и неподвижными тайлами
+PROFILE_WINDOW = 300  # За сколько последних кадров считаются перцентили профилировщика
+PROFILE_PHASES = ('events', 'sprite_change', 'animation', 'move', 'transition', 'draw', 'tick')
+SCENE_CACHE_SIZE = 4  # Сколько недавно посещенных уровней держать собранными
+SCENE_CACHE_LIMIT = 32 * 1024 * 1024  # Предел памяти под собранные уровни в байтах
+SPRITE_BYTES = 512  # Примерный размер одного спрайта со всеми его полями
+IDLE_TIMEOUT = 1000  # Сколько мс экран меню ждет события, прежде чем проверить себя снова
+RELOAD_INTERVAL = 500  # С --watch раз в столько мс проверяется, не изменился ли файл текущего уровня
+SWARM_MIN_ENEMIES = 32  # С --swarm уровни, где врагов меньше, все равно считаются по одному
+FRAME_TABLES = ('facing_left_frames', 'facing_right_frames', 'move_left_frames', 'move_right_frames',
+                'jump_frames_left', 'jump_frames_right')  # Наборы кадров Entity в порядке их на листе
+SCREEN_COLS, SCREEN_ROWS = -(-WIDTH // 32), -(-HEIGHT // 32)  # Тайлов в экране, уровни больше - прокручиваются
+CHUNK_TILES = 16  # Сторона куска большого уровня в тайлах
+CHUNK_MARGIN = 1  # Сколько кусков за краем экрана держать собранными и живыми
+# Дальше этого (в кусках от куска игрока) преследователи спят, и пути к игроку считать не нужно
+NAV_REACH = (-(-SCREEN_COLS // CHUNK_TILES) + CHUNK_MARGIN, -(-SCREEN_ROWS // CHUNK_TILES) + CHUNK_MARGIN)
+CHUNK_PAD = 7  # На сколько тайлов могут заходить на соседний кусок спрайты (подсказка 200x200)
+SPRITE_TILES = frozenset((TILE_IDS['s'], TILE_IDS['r']))  # Неподвижные спрайты, которые запекаются в фон
+ATLAS = None  # Собранный atlas.py атлас картинок, читается при первой картинке; False - атласа нет
+STARTUP_WORKERS = min(8, os.cpu_count() or 1)  # Потоков для чтения картинок и звуков при запуске
+STARTUP_IMAGES = ('characters/Jods.png', 'background.png', 'menu/menu.png', 'menu/play.png', 'menu/quit.png',
+                  'menu/death.png', 'menu/retry.png', 'menu/win.png')  # Картинки игрока и экранов меню
+STARTUP_SOUNDS = ('jump.wav', 'fall.wav')  # Музыка не декодируется заранее - она читается потоком
+PLAYER_FIELDS = ('dx', 'dy', 'air_time', 'carry_x', 'carry_y', 'cur_frame', 'faces', 'animation_loop', 'is_dead',
+                 'won')  # Что сохраняет снимок мира об игроке, кроме прямоугольника и кадра
+ENEMY_FIELDS = ('dx', 'dy', 'air_time', 'carry_x', 'carry_y', 'cur_frame', 'direction', 'origin', 'goal', 'heading')
+ENTITY_IMAGES = {'i': 'blocks/block1.png', 's': 'blocks/Spike.png', 'e': 'characters/enemy.png',
+                 'c': 'characters/enemy.png', 'f': 'flag.png', 'r': 'info.png'}  # Символ уровня -> картинка
 
 
-def sound_load(name):
-    full_name = os.path.join('data', 'sounds', name)
+class AssetCache:
+    # Общий кэш картинок и звуков: ключ (вид, путь, colorkey) -> ресурс.
+    # Рядом с картинкой хранится её маска, старые записи вытесняются по LRU
+    def __init__(self, max_bytes=ASSET_CACHE_LIMIT):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # ключ -> [ресурс, размер в байтах, маска]
+        self.surface_keys = dict()  # Surface -> ключ, чтобы найти маску по картинке
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()  # Уровни могут собираться в фоновом потоке
+
+    def get(self, key, loader, sizer):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return entry[0]
+            self.misses += 1
+            resource = loader()
+            entry = [resource, sizer(resource), None]
+            self.entries[key] = entry
+            self.size += entry[1]
+            if isinstance(resource, pygame.Surface):
+                self.surface_keys[resource] = key
+            self.evict()
+            return resource
+
+    def mask(self, surface):
+        with self.lock:
+            key = self.surface_keys.get(surface)
+            mask_size = surface.get_width() * surface.get_height() // 8
+            if key is None:  # Картинка не из кэша - маску не запоминаем
+                return MEMORY.track(pygame.mask.from_surface(surface), 'mask', 'без кэша', mask_size, surface)
+            entry = self.entries[key]
+            if entry[2] is None:
+                entry[2] = MEMORY.track(pygame.mask.from_surface(surface), 'mask', key[1], mask_size, surface)
+                entry[1] += mask_size
+                self.size += mask_size
+            return entry[2]
+
+    def evict(self):
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            key, entry = self.entries.popitem(last=False)
+            self.size -= entry[1]
+            self.surface_keys.pop(entry[0], None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.surface_keys.clear()
+            self.size = 0
+
+    def resident_bytes(self, kind):
+        with self.lock:
+            return sum(entry[1] for key, entry in self.entries.items() if key[0] == kind)
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.size,
+                'hits': self.hits, 'misses': self.misses}
+
+
+MEMORY = MemoryTracker()  # Учет живых картинок, масок и звуков; включают --memory и soak.py
+ASSETS = AssetCache()
+
+
+def asset_path(folder, name):
+    # Имена вида 'blocks\\block1.png' и 'blocks/block1.png' указывают на один файл
+    return os.path.join('data', folder, *name.replace('\\', '/').split('/'))
+
+
+def surface_size(image):
+    return image.get_bytesize() * image.get_width() * image.get_height()
+
+
+def sound_size(sound):
+    frequency, size, channels = pygame.mixer.get_init()
+    return int(sound.get_length() * frequency * channels * abs(size) // 8)
+
+
+def sound_decode(name):
+    full_name = asset_path('sounds', name)
     if not os.path.isfile(full_name):
         print('Файл со звуком {0} не найден'.format(full_name))
-    sound = pygame.mixer.Sound(full_name)
-    return sound
+    return pygame.mixer.Sound(full_name)
+
+
+def sound_load(name, decoded=None):
+    # decoded - звук, уже прочитанный из файла (при запуске звуки читаются в потоках)
+    def loader():
+        sound = sound_decode(name) if decoded is None else decoded
+        return MEMORY.track(sound, 'sound', name, sound_size(sound))
+    return ASSETS.get(('sound', asset_path('sounds', name)), loader, sound_size)
 
 
-def image_load(name, color_key=None):
-    full_name = os.path.join('data', 'sprites', name)
+def effect_play(name, volume=None, loops=0):
+    # Звук декодируется при первом проигрывании и остается в общем кэше ресурсов
+    if MUTED:
+        return
+    sound = sound_load(name)
+    if volume is not None:
+        sound.set_volume(volume)
+    sound.play(loops)
+
+
+def music_play(name, volume=1.0, loops=-1):
+    # Музыка читается с диска потоком через pygame.mixer.music, целиком в память не загружается
+    if MUTED:
+        return
+    pygame.mixer.music.load(asset_path('sounds', name))
+    pygame.mixer.music.set_volume(volume)
+    pygame.mixer.music.play(loops)
+
+
+def audio_stop():
+    if MUTED:
+        return
+    pygame.mixer.stop()
+    pygame.mixer.music.stop()
+
+
+def audio_resident_bytes():
+    # Сколько байт декодированного звука сейчас лежит в памяти
+    return ASSETS.resident_bytes('sound')
+
+
+def image_decode(name, color_key=None):
+    # Картинка из файла без convert_alpha: от дисплея не зависит, поэтому можно читать в потоке
+    full_name = asset_path('sprites', name)
     if not os.path.isfile(full_name):
         print('Файл с изображением {0} не найден'.format(full_name))
     image = pygame.image.load(full_name)
     if color_key is not None:
         if color_key == -1:
-            color_key = image.get_at((0, 0))
+            image.set_colorkey(image.get_at((0, 0)))
         else:
             image.set_colorkey(color_key)
-    else:
-        image = image.convert_alpha()
     return image
 
 
-def level_load(name):
-    full_name = os.path.join('data', 'levels', name)
-    with open(full_name, mode='r') as file:
-        level = file.read()
-        level = level.split('\n')
-    return level
+def image_load(name, color_key=None, decoded=None):
+    # decoded - картинка, уже прочитанная image_decode (при запуске картинки читаются в потоках)
+    full_name = asset_path('sprites', name)
+    if color_key is not None and color_key != -1:
+        color_key = tuple(color_key)  # Чтобы цвет можно было использовать в ключе кэша
+
+    def loader():
+        image = decoded
+        if image is None and color_key is None:
+            image = atlas_image(name)
+            if image is not None:
+                return MEMORY.track(image, 'surface', name, 0)
+        if image is None:
+            image = image_decode(name, color_key)
+        if color_key is None:
+            image = image.convert_alpha()
+        return MEMORY.track(image, 'surface', name, image_size(image))
+    return ASSETS.get(('image', full_name, color_key), loader, image_size)
+
+
+def atlas_image(name):
+    # Картинка из атласа, если он собран и в нем есть свежая копия name
+    with ASSETS.lock:
+        if ATLAS is None:
+            atlas_set(atlas_load())
+    return ATLAS.get(name) if ATLAS else None
+
+
+def atlas_set(atlas):
+    global ATLAS
+    ATLAS = atlas or False
+    if ATLAS:
+        MEMORY.track(ATLAS.image, 'surface', 'atlas', surface_size(ATLAS.image))
+
+
+def startup_manifest(name):
+    # Все, что нужно меню, экранам смерти и победы, игроку и уровню name: (картинки, звуки)
+    images = list(STARTUP_IMAGES)
+    for tile_id in sorted(set(compiled_level_load(name).tiles)):
+        if tile_id in SOLID_TILES:
+            images.append('blocks/block{0}.png'.format(tile_id))
+        elif SYMBOLS[tile_id] in ENTITY_IMAGES:
+            images.append(ENTITY_IMAGES[SYMBOLS[tile_id]])
+    sounds = list() if MUTED else list(STARTUP_SOUNDS)
+    return list(dict.fromkeys(images)), sounds
+
+
+def assets_preload(images, sounds, progress=None, workers=STARTUP_WORKERS):
+    # Картинки и звуки читаются пулом потоков: pygame отпускает GIL, пока разбирает PNG и WAV.
+    # convert_alpha зависит от дисплея, поэтому он и запись в кэш - в главном потоке, по мере
+    # готовности. Картинки из атласа ждут только сам атлас. progress(готово, всего) вызывается
+    # после каждого ресурса. Возвращает время в нс: ожидание чтения и работа главного потока
+    times = {'decode': 0, 'convert': 0}
+    start = perf_counter_ns()
+    index = atlas_index() if ATLAS is None else None
+    in_atlas = [name for name in images if index is not None and logical_name(name) in index]
+    total = len(images) + len(sounds)
+    done = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        tasks = dict()  # Задача -> (вид, имя)
+        if in_atlas:
+            tasks[executor.submit(atlas_load, index, False)] = ('atlas', None)
+        for name in images:
+            if name not in in_atlas:
+                tasks[executor.submit(image_decode, name)] = ('image', name)
+        for name in sounds:
+            tasks[executor.submit(sound_decode, name)] = ('sound', name)
+        pending = set(tasks)
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for task in finished:
+                kind, name = tasks[task]
+                convert_start = perf_counter_ns()
+                if kind == 'atlas':
+                    atlas = task.result()
+                    with ASSETS.lock:
+                        if ATLAS is None:
+                            if atlas is not None:
+                                atlas.image = atlas.image.convert_alpha()
+                            atlas_set(atlas)
+                    for image_name in in_atlas:  # Без атласа картинка прочитается из файла здесь же
+                        image_load(image_name)
+                    done += len(in_atlas)
+                elif kind == 'image':
+                    image_load(name, decoded=task.result())
+                    done += 1
+                else:
+                    sound_load(name, decoded=task.result())
+                    done += 1
+                times['convert'] += perf_counter_ns() - convert_start
+                if progress is not None:
+                    progress(done, total)
+    times['decode'] = perf_counter_ns() - start - times['convert']
+    return times
+
+
+def image_size(image):
+    # Части атласа своей памяти не занимают, атлас один на всю игру
+    return 0 if image.get_parent() is not None else surface_size(image)
+
+
+def mask_load(image):
+    return ASSETS.mask(image)
+
+
+class SpriteSheet:
+    # Лист кадров, нарезанный один раз: кадры, маска каждого кадра и именованные наборы кадров.
+    # Один на все спрайты с той же картинкой и раскладкой, сами спрайты только ссылаются на него
+    def __init__(self, image, columns, rows, counts=()):
+        self.size = (image.get_width() // columns, image.get_height() // rows)
+        self.frames = [image.subsurface(pygame.Rect((self.size[0] * i, self.size[1] * j), self.size))
+                       for j in range(rows) for i in range(columns)]
+        self.masks = {frame: pygame.mask.from_surface(frame) for frame in self.frames}  # Кадр -> его маска
+        self.tables = dict()  # Имя набора -> список кадров
+        start = 0
+        for name, count in zip(FRAME_TABLES, counts):
+            if count != 0 or name == FRAME_TABLES[0]:
+                self.tables[name] = self.frames[start:start + count]
+            start += count
+
+
+def sheet_size(sheet):
+    # Кадры - части исходной картинки, своей памяти занимают только маски
+    return len(sheet.frames) * (sheet.size[0] * sheet.size[1] // 8)
+
 
+def sheet_load(image, columns, rows, counts=()):
+    key = ASSETS.surface_keys.get(image)
 
-class AnimatedSprite(pygame.sprite.Sprite):
-    def __init__(self, all_sprites, image, columns, rows):
+    def loader():
+        # Маски кадров учитываются одной записью на лист
+        sheet = SpriteSheet(image, columns, rows, counts)
+        return MEMORY.track(sheet, 'mask', 'без кэша' if key is None else key[1], sheet_size(sheet))
+    if key is None:  # Картинка не из кэша - лист не запоминаем
+        return loader()
+    return ASSETS.get(('sheet', key, columns, rows, tuple(counts)), loader, sheet_size)
+
+
+class AnimatedSprite(pygame.sprite.DirtySprite):
+    def __init__(self, all_sprites, image, columns, rows, counts=()):
         super().__init__(all_sprites)
-        self.frames = list()
-        self.frame_list = list()
+        self.sheet = sheet_load(image, columns, rows, counts)
+        self.frames = self.sheet.frames
         self.frame_list = self.frames
-        self.cut_sheet(image, columns, rows)
+        self.rect = pygame.Rect((0, 0), self.sheet.size)
         self.cur_frame = 0
-        self.image = self.frame_list[self.cur_frame]
-        self.mask = pygame.mask.from_surface(self.image)
-
-    def cut_sheet(self, sheet, columns, rows):
-        self.rect = pygame.Rect(0, 0, sheet.get_width() // columns,
-                                sheet.get_height() // rows)
-        for j in range(rows):
-            for i in range(columns):
-                frame_location = (self.rect.w * i, self.rect.h * j)
-                self.frames.append(sheet.subsurface(pygame.Rect(
-                    frame_location, self.rect.size)))
+        self.show_frame(self.cur_frame)
+
+    def show_frame(self, index):
+        # Картинка и маска меняются вместе, чтобы collide_mask проверял тот кадр, что на экране
+        self.image = self.frame_list[index]
+        self.mask = self.sheet.masks[self.image]
 
     def update(self):
         self.cur_frame = (self.cur_frame + 1) % len(self.frame_list)
-        self.image = self.frame_list[self.cur_frame]
+        self.show_frame(self.cur_frame)
+        self.dirty = max(self.dirty, 1)
 
 
 class Entity(AnimatedSprite):
@@ -73,59 +372,68 @@ class Entity(AnimatedSprite):
     def __init__(self, all_sprites, image, columns, rows, pos_x, pos_y, facing_left_count,
                  facing_right_count, moving_left_count, moving_right_count, jumpframes_left_count=0,
                  jumpframes_right_count=0):
-        super().__init__(all_sprites, image, columns, rows)
+        super().__init__(all_sprites, image, columns, rows,
+                         (facing_left_count, facing_right_count, moving_left_count, moving_right_count,
+                          jumpframes_left_count, jumpframes_right_count))
         self.dy = 0
         self.dx = 0
         self.pos_x = pos_x
         self.pos_y = pos_y
         self.pos = (self.pos_x, self.pos_y)
         self.x_speed = 5
+        self.carry_x = 0.0  # Дробные остатки сдвига при шагах физики не обычной длины
+        self.carry_y = 0.0
+        self.dirty = 2  # Персонажи двигаются каждый кадр - всегда перерисовываются
 
-        # Списки фреймов
-        self.facing_left_frames = self.frames[:facing_left_count]
-        if facing_right_count != 0:
-            self.facing_right_frames = self.frames[facing_left_count:facing_left_count + facing_right_count]
-        if moving_left_count != 0:
-            self.move_left_frames = self.frames[facing_left_count + facing_right_count:
-                                                facing_left_count + facing_right_count + moving_left_count]
-        if moving_right_count != 0:
-            self.move_right_frames = self.frames[facing_left_count + facing_right_count + moving_left_count:
-                                                 facing_left_count + facing_right_count + moving_left_count +
-                                                 moving_right_count]
-        if jumpframes_left_count != 0:
-            self.jump_frames_left = self.frames[facing_left_count + facing_right_count +
-                                                moving_left_count + moving_right_count:
-                                                jumpframes_left_count + facing_left_count +
-                                                facing_right_count + moving_left_count + moving_right_count]
-        if jumpframes_right_count != 0:
-            self.jump_frames_right = self.frames[jumpframes_left_count + facing_left_count +
-                                                 facing_right_count + moving_left_count + moving_right_count:
-                                                 jumpframes_left_count + jumpframes_right_count + facing_left_count +
-                                                 facing_right_count + moving_left_count + moving_right_count]
-        # Списки фреймов
+        # Списки фреймов, общие для всех спрайтов с этим листом
+        for name, frames in self.sheet.tables.items():
+            setattr(self, name, frames)
 
         self.frame_list = self.facing_right_frames  # Активные фреймы
-        self.mask = pygame.mask.from_surface(self.image)
         self.rect = self.mask.get_rect()
         self.rect.topleft = self.pos
 
+    def shift(self, dx, dy, scale=1):
+        # На обычном шаге дробный сдвиг округляет Rect, как всегда. На шагах другой длины
+        # остаток копится, иначе округление каждого шага ускоряло бы или тормозило движение
+        if scale == 1:
+            self.rect.x += dx
+            self.rect.y += dy
+            return
+        self.carry_x += dx
+        self.carry_y += dy
+        whole_x, whole_y = int(self.carry_x), int(self.carry_y)
+        self.carry_x -= whole_x
+        self.carry_y -= whole_y
+        self.rect.move_ip(whole_x, whole_y)
+
 
 class Block(pygame.sprite.Sprite):
     def __init__(self, all_sprites, image, pos_x, pos_y, is_fake=False):
-        if not is_fake:
-            super().__init__(all_sprites)
+        # Ненастоящий блок не рисуется и в группу не входит, но остается спрайтом: перезагрузка уровня его kill
+        super().__init__(*(() if is_fake else (all_sprites,)))
         self.pos_x = pos_x
         self.pos_y = pos_y
         self.is_fake = is_fake
         if not is_fake:
             self.image = image
-            self.mask = pygame.mask.from_surface(self.image)
+            self.mask = mask_load(self.image)
             self.rect = self.mask.get_rect()
         else:
             self.rect = pygame.Rect(pos_x, pos_y, 64, 64)
         self.rect.topleft = (pos_x, pos_y)
 
 
+class Solid(pygame.sprite.Sprite):
+    # Прямоугольник столкновений из нескольких слитых блоков, сам не рисуется (блоки в фоне уровня)
+    def __init__(self, pos_x, pos_y, width, height):
+        super().__init__()
+        self.pos_x = pos_x
+        self.pos_y = pos_y
+        self.is_fake = False
+        self.rect = pygame.Rect(pos_x, pos_y, width, height)
+
+
 class Spike(Block):
     def __init__(self, all_sprites, image, pos_x, pos_y):
         super().__init__(all_sprites, image, pos_x, pos_y)
@@ -134,7 +442,7 @@ class Spike(Block):
         self.image = image
         self.rect = self.image.get_rect()
         self.rect.topleft = (self.pos_x, self.pos_y)
-        self.mask = pygame.mask.from_surface(self.image)
+        self.mask = mask_load(self.image)
 
 
 class Player(Entity):
@@ -144,15 +452,15 @@ class Player(Entity):
         super().__init__(all_sprites, image, columns, rows, pos_x, pos_y, facing_left_count,
                          facing_right_count, moving_left_count, moving_right_count, jumpframes_left_count,
                          jumpframes_right_count)
-        self.jump_sound = sound_load('jump.wav')
-        self.fall_sound = sound_load('fall.wav')
         self.won = False
         self.faces = 'right'
         self.air_time = 0
         self.animation_loop = True
         self.is_dead = False
 
-    def move(self, direction, blocks):
+    def move(self, direction, blocks, scale=1, width=None):
+        # scale - во сколько раз шаг физики длиннее шага при BASE_RATE, width - ширина уровня:
+        # за его края игрок не выходит еще до сдвига по y, иначе на длинном шаге пролетел бы мимо крайних блоков
         if not self.is_dead:
             if 'left' in direction:
                 self.dx = -1
@@ -163,57 +471,73 @@ class Player(Entity):
             if ('left' in direction and 'right' in direction) or \
                     ('left' not in direction and 'right' not in direction):
                 self.dx = 0
-            self.rect.x += self.dx * self.x_speed
-            collision_list = collide_detect(self, blocks)
+            start = self.rect.copy()
+            self.shift(self.dx * self.x_speed * scale, 0, scale)
+            collision_list = collide_detect(self, blocks, start)
             for block in collision_list:
-                if not block.is_fake:
+                if embedded(block, start):
+                    self.rect.move_ip(push_out(self.rect, block.rect))
+                elif not block.is_fake:
                     if self.dx > 0:
                         self.rect.right = block.rect.left
                     elif self.dx < 0:
                         self.rect.left = block.rect.right
                     if type(block) == Flag:
                         self.won = True
-            self.rect.y -= 10 * self.dy / 100  # Падение
+            if width is not None and self.dx > 0:
+                self.rect.right = min(self.rect.right, width)
+            elif width is not None and self.dx < 0:
+                self.rect.left = max(self.rect.left, 0)
+            start = self.rect.copy()
+            self.shift(0, -10 * self.dy / 100 * scale, scale)  # Падение
             if self.dy >= -70:  # Если меньше - перестает ускоряться
-                self.dy -= 5  # Ускорение падения
-            collision_list = collide_detect(self, blocks)
+                self.dy -= 5 * scale  # Ускорение падения
+            collision_list = collide_detect(self, blocks, start)
             self.air_time += 1
+            # Куда упираться - по тому, куда сдвинулся: за длинный шаг dy может смениться на падение
+            # еще при движении вверх. Без сдвига - по dy, как при обычном шаге. Погибший на этом
+            # сдвиге ни во что не упирается (раньше это делал обнуленный в die dy)
+            falling = not self.is_dead and (self.rect.y > start.y or (self.rect.y == start.y and self.dy < 0))
+            rising = not self.is_dead and (self.rect.y < start.y or (self.rect.y == start.y and self.dy > 0))
             for block in collision_list:
-                if not block.is_fake:
-                    if self.dy < 0:
+                if embedded(block, start):
+                    self.rect.move_ip(push_out(self.rect, block.rect))
+                elif not block.is_fake and (falling or rising):
+                    if falling:
                         self.rect.bottom = block.rect.top
                         self.dy = 0
                         self.air_time = 0
                         self.animation_loop = True
-                    elif self.dy > 0:
+                    else:
                         self.rect.top = block.rect.bottom
                         self.dy = 0
+                    break  # Как раньше: после первого блока dy = 0, остальные уже не двигают
             if self.air_time == 3:
                 self.cur_frame = 0
         else:
-            self.rect.y -= 10 * self.dy / 100  # Падение
-            self.dy -= 5  # Ускорение падения
-            self.rect.x += self.dx * self.x_speed
+            self.shift(0, -10 * self.dy / 100 * scale, scale)  # Падение
+            self.dy -= 5 * scale  # Ускорение падения
+            self.shift(self.dx * self.x_speed * scale, 0, scale)
             self.air_time += 2
 
     def jump(self):
         self.animation_loop = False
         self.cur_frame = 0
         if self.air_time < 5:
-            self.dy = 120
-            self.jump_sound.play()
+            self.dy = JUMP_DY
+            effect_play('jump.wav')
 
     def update(self):
         if not self.is_dead:
             if self.animation_loop:
                 self.cur_frame = (self.cur_frame + 1) % len(self.frame_list)
-                self.image = self.frame_list[self.cur_frame]
+                self.show_frame(self.cur_frame)
             else:
                 if self.cur_frame < len(self.frame_list) - 1:
-                    self.image = self.frame_list[self.cur_frame]
+                    self.show_frame(self.cur_frame)
                     self.cur_frame += 1
                 else:
-                    self.image = self.frame_list[self.cur_frame]
+                    self.show_frame(self.cur_frame)
 
     def sprite_change(self):
         if self.air_time < 3:
@@ -236,9 +560,8 @@ class Player(Entity):
 
     def die(self):
         self.is_dead = True
-        pygame.mixer.stop()
-        self.fall_sound.set_volume(0.3)
-        self.fall_sound.play(-1)
+        audio_stop()
+        effect_play('fall.wav', volume=0.3, loops=-1)
         self.dy = 0
         self.dx = self.dx / 2
         self.air_time = 3
@@ -247,12 +570,12 @@ class Player(Entity):
 class Enemy(Entity):
     def __init__(self, all_sprites, image, columns, rows, pos_x, pos_y, facing_left_count,
                  facing_right_count, moving_left_count, moving_right_count, jumpframes_left_count=0,
-                 jumpframes_right_count=0):
+                 jumpframes_right_count=0, rng=RNG):
         super().__init__(all_sprites, image, columns, rows, pos_x, pos_y, facing_left_count,
                          facing_right_count, moving_left_count, moving_right_count, jumpframes_left_count,
                          jumpframes_right_count)
         self.dy = 0
-        self.dx = randint(-1, 1)
+        self.dx = rng.randint(-1, 1)
         self.frame_list = self.facing_right_frames
         self.direction = list()
         self.direction.append('left')
@@ -260,38 +583,51 @@ class Enemy(Entity):
         self.air_time = 0
         self.x_speed = 3
         self.rect = self.mask.get_rect()
+        self.origin = None  # Клетка уровня, из которой враг создан, задает entities_build
         self.rect.bottomleft = (pos_x, pos_y)
 
-    def move(self, blocks):
+    def move(self, blocks, scale=1):
         self.collision_sides = {'left': False, 'right': False, 'top': False, 'bottom': False}
         if 'left' in self.direction:
             self.dx = -1
         if 'right' in self.direction:
             self.dx = 1
-        self.rect.x += self.dx * self.x_speed
-        collision_list = collide_detect(self, blocks)
-        for block in collision_list:
-            if self.dx > 0:
+        start = self.rect.copy()
+        self.shift(self.dx * self.x_speed * scale, 0, scale)
+        collision_list = collide_detect(self, blocks, start)
+        for block in collision_list:  # Блоков может быть несколько, разворот - один
+            if embedded(block, start):
+                self.rect.move_ip(push_out(self.rect, block.rect))
+            elif self.dx > 0:
                 self.rect.right = block.rect.left
                 self.collision_sides['right'] = True
-                self.direction.append('left')
-                self.direction.pop(self.direction.index('right'))
+                self.direction = ['left']
             elif self.dx < 0:
                 self.rect.left = block.rect.right
                 self.collision_sides['left'] = True
-                self.direction.append('right')
-                self.direction.pop(self.direction.index('left'))
-        self.rect.y -= 10 * self.dy / 100  # Падение
+                self.direction = ['right']
+        start = self.rect.copy()
+        self.shift(0, -10 * self.dy / 100 * scale, scale)  # Падение
         if self.dy >= -70:  # Если меньше - перестает ускоряться
-            self.dy -= 5  # Ускорение падения
-        collision_list = collide_detect(self, blocks)
+            self.dy -= 5 * scale  # Ускорение падения
+        collision_list = collide_detect(self, blocks, start)
         self.air_time += 1
+        falling = self.rect.y > start.y or (self.rect.y == start.y and self.dy < 0)  # Как у Player.move
+        rising = self.rect.y < start.y or (self.rect.y == start.y and self.dy > 0)
         for block in collision_list:
-            if self.dy < 0:
+            if embedded(block, start):
+                self.rect.move_ip(push_out(self.rect, block.rect))
+            elif falling:
                 self.rect.bottom = block.rect.top
                 self.collision_sides['bottom'] = True
                 self.dy = 0
                 self.air_time = 0
+                break
+            if rising:  # Только у прыгающих (Chaser)
+                self.rect.top = block.rect.bottom
+                self.collision_sides['top'] = True
+                self.dy = 0
+                break
 
     def sprite_change(self):
         if self.air_time < 3:
@@ -307,98 +643,1332 @@ class Enemy(Entity):
                     self.frame_list = self.facing_left_frames
 
 
-def collide_detect(character, things):
+class Chaser(Enemy):
+    # Враг, который идет к игроку по графу навигации уровня (NavGraph): шагает, спрыгивает
+    # и прыгает. Решение принимается, когда он стоит на земле; в воздухе держит направление
+    def __init__(self, all_sprites, image, columns, rows, pos_x, pos_y, facing_left_count,
+                 facing_right_count, moving_left_count, moving_right_count, jumpframes_left_count=0,
+                 jumpframes_right_count=0, rng=RNG):
+        super().__init__(all_sprites, image, columns, rows, pos_x, pos_y, facing_left_count,
+                         facing_right_count, moving_left_count, moving_right_count, jumpframes_left_count,
+                         jumpframes_right_count, rng)
+        self.nav = None  # Граф уровня, задает LevelScene
+        self.target = None  # За кем идти, задает World
+        self.goal = None  # Последний узел, на котором цель стояла
+        self.heading = -1
+
+    def move(self, blocks, scale=1):
+        if self.nav is not None and self.target is not None:
+            self.steer()
+        super().move(blocks, scale)
+
+    def steer(self):
+        if self.air_time == 0:
+            self.goal = self.nav.node_at(self.target.rect) or self.goal
+            node = self.nav.node_at(self.rect)
+            step = None
+            if node is not None and self.goal is not None:
+                step = self.nav.next_action(node, self.goal)
+            if step is None:  # Уже рядом или пути нет - просто к цели
+                if self.target.rect.centerx != self.rect.centerx:
+                    self.heading = 1 if self.target.rect.centerx > self.rect.centerx else -1
+            else:
+                (kind, dx), next_node = step
+                self.heading = dx
+                if kind == 'jump':  # Прыжок просчитан от начала узла - сначала дойти до него
+                    start = node[0] * TILE
+                    if abs(self.rect.x - start) <= self.x_speed:
+                        self.rect.x = start
+                        self.dy = JUMP_DY
+                    else:
+                        self.heading = 1 if start > self.rect.x else -1
+        self.direction = ['right'] if self.heading > 0 else ['left']
+
+
+def level_nav(level, enemies, reach=None):
+    # Граф навигации для уровня с преследователями (или None, если их нет). Строится в фоне:
+    # уровень в один экран - сразу весь, большой (reach) - по кускам, которые собирает ChunkedScene.stream
+    chasers = [enemy for enemy in enemies if type(enemy) == Chaser]
+    if not chasers:
+        return None
+    nav = NavGraph(level.tiles, level.cols, level.rows, chasers[0].rect.size, chasers[0].x_speed, reach, CHUNK_TILES)
+    if reach is None:
+        nav.prepare(0, 0, level.cols, level.rows)
+    for chaser in chasers:
+        chaser.nav = nav
+    return nav
+
+
+class SpatialGrid(list):
+    # Список объектов уровня с индексом по клеткам сетки.
+    # Обходится как обычный список, а query отдает только объекты из клеток под прямоугольником
+    def __init__(self, items=(), cell_size=GRID_CELL):
+        super().__init__()
+        self.cell_size = cell_size
+        self.cells = dict()  # (столбец, строка) -> объекты в клетке
+        self.places = dict()  # id объекта -> (порядковый номер, занятые клетки)
+        self.counter = 0
+        self.extend(items)
+
+    def cells_under(self, rect):
+        size = self.cell_size
+        return [(col, row) for col in range(rect.left // size, (rect.right - 1) // size + 1)
+                for row in range(rect.top // size, (rect.bottom - 1) // size + 1)]
+
+    def append(self, item):
+        super().append(item)
+        self.counter += 1
+        cells = self.cells_under(item.rect)
+        self.places[id(item)] = (self.counter, cells)
+        for cell in cells:
+            self.cells.setdefault(cell, []).append(item)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def remove(self, item):
+        super().remove(item)
+        order, cells = self.places.pop(id(item))
+        self.unlink(item, cells)
+
+    def clear(self):
+        super().clear()
+        self.cells.clear()
+        self.places.clear()
+
+    def unlink(self, item, cells):
+        for cell in cells:
+            bucket = self.cells[cell]
+            bucket.remove(item)
+            if not bucket:
+                del self.cells[cell]
+
+    def relocate(self, item):
+        # Перекладывает подвижный объект (врага) в клетки под его новым прямоугольником
+        order, cells = self.places[id(item)]
+        new_cells = self.cells_under(item.rect)
+        if new_cells != cells:
+            self.unlink(item, cells)
+            for cell in new_cells:
+                self.cells.setdefault(cell, []).append(item)
+            self.places[id(item)] = (order, new_cells)
+
+    def query(self, rect):
+        found = dict()
+        for cell in self.cells_under(rect):
+            for item in self.cells.get(cell, ()):
+                found[id(item)] = item
+        if len(found) < 2:
+            return list(found.values())
+        # Тот же порядок, что и при обходе всего списка
+        return sorted(found.values(), key=lambda item: self.places[id(item)][0])
+
+
+class CollisionStats:
+    # Сколько проверок столкновений и попиксельных проверок масок было с последнего сброса
+    def __init__(self):
+        self.checks = 0
+        self.masks = 0
+
+    def reset(self):
+        self.checks = 0
+        self.masks = 0
+
+
+COLLISION_STATS = CollisionStats()
+
+
+def collide_detect(character, things, start=None):
+    # start - прямоугольник персонажа до сдвига по одной оси. Тогда находится и то, что сдвиг
+    # перескочил бы целиком (swept AABB): если такое есть, отдаются только ближние по пути блоки,
+    # в которые персонаж упрется первыми. Шипы и враги по пути проверяются масками вдоль сдвига
+    rect = character.rect
+    swept = rect if start is None or start == rect else rect.union(start)
     collide_list = list()
+    if isinstance(things, SpatialGrid):
+        things = things.query(swept)
+    COLLISION_STATS.checks += len(things)
     for thing in things:
-        if not type(thing) == Spike and not type(thing) == Enemy:
-            if character.rect.colliderect(thing.rect):
+        passed = swept is not rect and swept.colliderect(thing.rect) and not start.colliderect(thing.rect)
+        if not type(thing) == Spike and not isinstance(thing, Enemy):
+            if character.rect.colliderect(thing.rect) or passed:
                 collide_list.append(thing)
-        elif (type(thing) == Spike or type(thing) == Enemy) and type(character) == Player:
-            if pygame.sprite.collide_mask(character, thing):
+        elif (type(thing) == Spike or isinstance(thing, Enemy)) and type(character) == Player:
+            COLLISION_STATS.masks += 1
+            if pygame.sprite.collide_mask(character, thing) or (passed and mask_on_path(character, thing, start)):
                 character.dy = 0
                 character.die()
         elif type(thing) == Flag and type(character) == Player:
             character.won = True
+    if swept is not rect and any(not rect.colliderect(thing.rect) for thing in collide_list):
+        stops = [thing for thing in collide_list if not (thing.is_fake and type(character) == Player)]
+        if stops:
+            nearest = min(rect_gap(start, thing.rect) for thing in stops)
+            collide_list = [thing for thing in stops if rect_gap(start, thing.rect) == nearest]
     return collide_list
 
 
-def level_change(all_sprites, name, jod, things, blocks, enemies):
-    global CURRENT_LEVEL
-    jod_pos = None
-    all_sprites.empty()
-    things.clear()
-    blocks.clear()
-    enemies.clear()
-    if LEVEL_LIST.index(name) > LEVEL_LIST.index(CURRENT_LEVEL):
-        jod.rect.y = HEIGHT
-    elif LEVEL_LIST.index(name) > LEVEL_LIST.index(CURRENT_LEVEL):
-        jod.rect.y = 0
-    level = level_load(name)
-    CURRENT_LEVEL = name
-    row_count = 0
-    for row in level:
-        row_count += 1
-        symbol_count = 0
-        for symbol in row:
-            symbol_count += 1
-            if symbol != '#':
-                if symbol == 'J':
-                    jod_pos = ((32 * symbol_count), (32 * row_count - 32))
-                if symbol == '1':
-                    blocks.append(Block(all_sprites, image_load('blocks\\block1.png'), (32 * symbol_count - 32),
-                                        (32 * row_count - 32)))
-                if symbol == '2':
-                    blocks.append(Block(all_sprites, image_load('blocks\\block2.png'), (32 * symbol_count - 32),
-                                        (32 * row_count - 32)))
-                if symbol == '3':
-                    blocks.append(Block(all_sprites, image_load('blocks\\block3.png'), (32 * symbol_count - 32),
-                                        (32 * row_count - 32)))
-                if symbol == '4':
-                    blocks.append(Block(all_sprites, image_load('blocks\\block4.png'), (32 * symbol_count - 32),
-                                        (32 * row_count - 32)))
-                if symbol == '5':
-                    blocks.append(Block(all_sprites, image_load('blocks\\block5.png'), (32 * symbol_count - 32),
-                                        (32 * row_count - 32)))
-                if symbol == '6':
-                    blocks.append(Block(all_sprites, image_load('blocks\\block6.png'), (32 * symbol_count - 32),
-                                        (32 * row_count - 32)))
-                if symbol == 'i':
-                    blocks.append(Block(all_sprites, image_load('blocks\\block1.png'), (32 * symbol_count - 32),
-                                        (32 * row_count - 32), is_fake=True))
-                if symbol == 's':
-                    blocks.append(Spike(all_sprites, image_load('blocks\\spike.png'), (32 * symbol_count - 32),
-                                        (32 * row_count - 32)))
-                if symbol == 'e':
-                    enemies.append(Enemy(all_sprites, image_load('characters\\enemy.png'),
-                                         2, 3, (32 * symbol_count - 32), (32 * row_count), 1, 1, 2, 2, 0, 0))
-                if symbol == 'f':
-                    blocks.append(Flag(all_sprites, image_load('flag.png'), 1, 3, (32 * symbol_count - 32),
-                                       (32 * row_count - 32)))
-                if symbol == 'r':
-                    things.append(Instruction(all_sprites, (32 * symbol_count - 32),
-                                              (32 * row_count - 32)))
+def push_out(rect, other):
+    # Сдвиг, который выводит rect из other по наименьшему перекрытию
+    return min(((other.left - rect.right, 0), (other.right - rect.left, 0),
+                (0, other.top - rect.bottom), (0, other.bottom - rect.top)), key=lambda move: abs(move[0] + move[1]))
+
+
+def embedded(thing, start):
+    # Персонаж стоял в слитом блоке еще до сдвига (так поставлен на уровне или переходом между уровнями).
+    # Упираться в край такого блока нельзя - край может быть на другом конце слитого прямоугольника
+    return type(thing) == Solid and start.colliderect(thing.rect)
+
+
+def rect_gap(rect, other):
+    # Расстояние между прямоугольниками по той оси, по которой они разнесены (меньше нуля - пересекаются)
+    return max(other.left - rect.right, rect.left - other.right, other.top - rect.bottom, rect.top - other.bottom)
+
+
+def mask_on_path(character, thing, start):
+    # Задевает ли маска персонажа маску thing где-то между start и текущим местом (конец проверен отдельно)
+    dx, dy = character.rect.x - start.x, character.rect.y - start.y
+    parts = -(-max(abs(dx), abs(dy)) // MASK_STEP)
+    for part in range(parts):
+        x, y = start.x + dx * part // parts, start.y + dy * part // parts
+        if character.mask.overlap(thing.mask, (thing.rect.x - x, thing.rect.y - y)):
+            return True
+    return False
+
+
+def level_build(all_sprites, name, things, blocks, enemies, rng=RNG):
+    # Создает спрайты уровня в переданных группах и списках, возвращает позицию игрока (или None).
+    # Глобальное состояние не трогает, поэтому может работать в фоновом потоке
+    level = compiled_level_load(name)
+    for col, row, width, height in level.rects:  # Слитые блоки - только для столкновений
+        blocks.append(Solid(32 * col, 32 * row, 32 * width, 32 * height))
+    jod_pos = entities_build(all_sprites, level.entities, things, blocks, enemies, rng)
     for block in blocks:
         things.append(block)
     for enemy in enemies:
         things.append(enemy)
-    if jod_pos is not None:
-        return enemies, blocks, things, jod_pos
-    else:
-        return enemies, blocks, things
+    return jod_pos
+
+
+def entities_build(all_sprites, entities, things, blocks, enemies, rng=RNG):
+    # Спрайты для сущностей уровня [(символ, столбец, строка)], возвращает позицию игрока (или None).
+    # У каждого спрайта origin - клетка уровня, из которой он создан (для перезагрузки уровня)
+    jod_pos = None
+    for symbol, col, row in entities:
+        sprite = None
+        if symbol == 'J':
+            jod_pos = ((32 * col + 32), (32 * row))
+        if symbol == 'i':
+            sprite = Block(all_sprites, image_load('blocks/block1.png'), (32 * col), (32 * row), is_fake=True)
+            blocks.append(sprite)
+        if symbol == 's':
+            sprite = Spike(all_sprites, image_load('blocks/Spike.png'), (32 * col), (32 * row))
+            blocks.append(sprite)
+        if symbol == 'e':
+            sprite = Enemy(all_sprites, image_load('characters/enemy.png'),
+                           2, 3, (32 * col), (32 * row + 32), 1, 1, 2, 2, 0, 0, rng=rng)
+            enemies.append(sprite)
+        if symbol == 'c':
+            sprite = Chaser(all_sprites, image_load('characters/enemy.png'),
+                            2, 3, (32 * col), (32 * row + 32), 1, 1, 2, 2, 0, 0, rng=rng)
+            enemies.append(sprite)
+        if symbol == 'f':
+            sprite = Flag(all_sprites, image_load('flag.png'), 1, 3, (32 * col), (32 * row))
+            blocks.append(sprite)
+        if symbol == 'r':
+            sprite = Instruction(all_sprites, (32 * col), (32 * row))
+            things.append(sprite)
+        if sprite is not None:
+            sprite.origin = (col, row)
+    return jod_pos
+
+
+class LevelScene:
+    # Собранный уровень: группа спрайтов и списки объектов, готовые к подстановке в World.
+    # swarm=True - враги двигаются все сразу массивами EnemySwarm, а спрайты только показывают их
+    def __init__(self, name, rng=RNG, swarm=False):
+        self.name = name
+        self.all_sprites = pygame.sprite.Group()
+        self.things = SpatialGrid()
+        self.blocks = SpatialGrid()
+        self.enemies = list()
+        self.rng = rng
+        self.jod_pos = level_build(self.all_sprites, name, self.things, self.blocks, self.enemies, rng)
+        level = compiled_level_load(name)
+        self.level = level
+        self.mtime = level.mtime
+        self.origins = {thing.origin: thing for thing in self.things if type(thing) != Solid}  # Клетка -> спрайт
+        self.enemy_start = [enemy_state(enemy) for enemy in self.enemies]  # Для сброса врагов при возврате
+        self.swarm = None
+        self.enemy_ticks = 0  # Шаги анимации врагов в режиме swarm
+        self.chunked = False
+        self.width, self.height = WIDTH, HEIGHT  # Уровень в один экран
+        self.nav = level_nav(level, self.enemies)  # Граф навигации, если есть преследователи
+        if swarm and EnemySwarm is None:
+            raise RuntimeError('Для врагов-массивов нужен NumPy')
+        # На паре врагов массивы только медленнее, а преследователи ходят только по одному
+        if swarm and len(self.enemies) >= SWARM_MIN_ENEMIES and self.nav is None:
+            self.things = SpatialGrid(thing for thing in self.things if type(thing) != Enemy)
+            self.swarm = EnemySwarm([tuple(enemy.rect) for enemy in self.enemies],
+                                    [1 if 'right' in enemy.direction else -1 for enemy in self.enemies],
+                                    [tuple(block.rect) for block in self.blocks if type(block) != Spike],
+                                    level.cols, level.rows)
+
+    def reset_enemies(self):
+        if self.swarm is not None:
+            self.swarm.reset()
+            self.enemy_ticks = 0
+            return
+        for enemy, state in zip(self.enemies, self.enemy_start):
+            enemy_restore(enemy, state)
+            self.things.relocate(enemy)
+
+    def sync_enemies(self, indices=None, alpha=1.0):
+        # Переносит положение врагов из массивов в их спрайты (для отрисовки и проверки масок).
+        # alpha < 1 - положение между предыдущим и текущим шагом, только для отрисовки
+        swarm = self.swarm
+        xs, ys, dxs = swarm.x, swarm.y, swarm.dx.tolist()
+        if alpha < 1 and swarm.previous is not None:
+            xs = swarm.previous[0] + (xs - swarm.previous[0]) * alpha
+            ys = swarm.previous[1] + (ys - swarm.previous[1]) * alpha
+        xs, ys = xs.round().astype(int).tolist(), ys.round().astype(int).tolist()
+        facing, air_time = swarm.facing.tolist(), swarm.air_time.tolist()
+        for index in range(len(self.enemies)) if indices is None else indices:
+            enemy = self.enemies[index]
+            enemy.rect.topleft = (xs[index], ys[index])
+            enemy.dx = dxs[index]
+            enemy.air_time = air_time[index]
+            enemy.direction = ['right'] if facing[index] > 0 else ['left']
+            enemy.sprite_change()
+            enemy.cur_frame = self.enemy_ticks % len(enemy.frame_list)
+            enemy.show_frame(enemy.cur_frame)
+
+    def size(self):
+        # Примерная память уровня: спрайты, маски врагов и запеченный фон
+        total = (len(self.all_sprites) + len(self.things)) * SPRITE_BYTES
+        for enemy in self.enemies:
+            total += enemy.rect.w * enemy.rect.h // 8
+        layer = LEVEL_LAYERS.get(self.name)
+        if layer is not None:
+            total += surface_size(layer)
+        return total
+
+    def actors(self):
+        return [sprite for sprite in self.all_sprites if isinstance(sprite, (Enemy, Flag))]
+
+    def static_sprites(self):
+        # В порядке чтения уровня, как их ждет level_layer, даже если часть пересоздана перезагрузкой
+        return sorted((sprite for sprite in self.all_sprites if not isinstance(sprite, (Enemy, Flag))),
+                      key=lambda sprite: (sprite.origin[1], sprite.origin[0]))
+
+    def reload(self, level):
+        # Файл уровня изменился: пересоздаются только спрайты и блоки из изменившихся клеток,
+        # остальное, в том числе не задетые правкой враги, остается как было.
+        # False - так нельзя (другой размер уровня, враги-массивы), уровень надо собрать заново
+        if self.swarm is not None or (level.cols, level.rows) != (self.level.cols, self.level.rows):
+            return False
+        changes = tile_changes(self.level, level)
+        self.level = level
+        self.mtime = level.mtime
+        if not changes:
+            return True
+        for cell in changes:
+            thing = self.origins.pop(cell, None)
+            if thing is None:
+                continue
+            if isinstance(thing, Enemy):
+                index = self.enemies.index(thing)
+                del self.enemies[index]
+                del self.enemy_start[index]
+            if id(thing) in self.blocks.places:
+                self.blocks.remove(thing)
+            self.things.remove(thing)
+            thing.kill()
+        removed, added = solids_patch(level, self.blocks, changes, (0, 0, level.cols, level.rows))
+        for block in removed:
+            self.blocks.remove(block)
+            self.things.remove(block)
+        self.blocks.extend(added)
+        self.things.extend(added)
+        things, blocks, enemies = list(), list(), list()
+        jod_pos = entities_build(self.all_sprites, changed_entities(changes), things, blocks, enemies, self.rng)
+        if jod_pos is not None:
+            self.jod_pos = jod_pos
+        for thing in blocks + things + enemies:
+            self.things.append(thing)
+            self.origins[thing.origin] = thing
+        self.blocks.extend(blocks)
+        for enemy in enemies:
+            self.enemies.append(enemy)
+            self.enemy_start.append(enemy_state(enemy))
+        if self.nav is not None:
+            self.nav.update(changes)
+            for enemy in enemies:
+                if type(enemy) == Chaser:
+                    enemy.nav = self.nav
+        else:
+            self.nav = level_nav(level, self.enemies)
+        LEVEL_LAYERS.pop(self.name, None)
+        return True
+
+
+def tile_changes(old, new):
+    # Клетки, где тайлы двух версий уровня одного размера различаются: {(столбец, строка): новый тайл}
+    changes = dict()
+    cols = old.cols
+    for row in range(old.rows):
+        start = row * cols
+        if old.tiles[start:start + cols] != new.tiles[start:start + cols]:
+            for col in range(cols):
+                if old.tiles[start + col] != new.tiles[start + col]:
+                    changes[(col, row)] = new.tiles[start + col]
+    return changes
+
+
+def changed_entities(changes):
+    # Сущности из изменившихся клеток в порядке чтения уровня, как их отдает компилятор
+    cells = sorted(changes, key=lambda cell: (cell[1], cell[0]))
+    return [(SYMBOLS[changes[cell]], cell[0], cell[1]) for cell in cells if changes[cell] in ENTITY_TILES]
+
+
+def solids_patch(level, blocks, changes, area):
+    # Слитые блоки столкновений заново только вокруг изменившихся клеток внутри area
+    # (столбец, строка, ширина, высота): прямоугольники, задевшие эти клетки, убираются,
+    # а их клетки сливаются снова по новому уровню. Возвращает (убранные Solid, новые Solid)
+    left, top, width, height = area
+    cells = set()
+    removed = list()
+    for col, row in changes:
+        if not (left <= col < left + width and top <= row < top + height):
+            continue
+        cells.add((col, row))
+        for block in blocks.query(pygame.Rect(32 * col, 32 * row, 32, 32)):
+            if type(block) == Solid and block not in removed:
+                removed.append(block)
+                cells.update((c, r) for c in range(block.rect.left // 32, block.rect.right // 32)
+                             for r in range(block.rect.top // 32, block.rect.bottom // 32))
+    if not cells:
+        return removed, list()
+    patch = bytearray(len(level.tiles))  # Только эти клетки, чтобы не слить заново нетронутые блоки
+    for col, row in cells:
+        patch[row * level.cols + col] = level.tile(col, row)
+    first_col, first_row = min(col for col, row in cells), min(row for col, row in cells)
+    last_col, last_row = max(col for col, row in cells), max(row for col, row in cells)
+    rects = merge_solids(patch, level.cols, level.rows,
+                         (first_col, first_row, last_col - first_col + 1, last_row - first_row + 1), cells)
+    return removed, [Solid(32 * col, 32 * row, 32 * w, 32 * h) for col, row, w, h in rects]
+
+
+class LevelChunk:
+    # Кусок большого уровня: блоки столкновений, неподвижные спрайты и флаги, лежащие в нем.
+    # Фон куска запекается при первой отрисовке и живет, пока кусок собран
+    def __init__(self, key, rect):
+        self.key = key  # (столбец, строка) куска
+        self.rect = rect  # Место куска на уровне в пикселях
+        self.blocks = list()
+        self.things = list()  # Подсказки - только в things, как в level_build
+        self.sprites = list()
+        self.layer = None
+
+
+class ChunkedScene:
+    # Уровень больше экрана. Собраны только куски CHUNK_TILES x CHUNK_TILES вокруг камеры
+    # (stream), дальние выгружаются. Враги из выгруженных кусков хранятся как enemy_state
+    # и появляются снова, когда их кусок собирается. Запоминать фон всего уровня не нужно
+    def __init__(self, name, rng=RNG, swarm=False):
+        level = compiled_level_load(name)
+        self.name = name
+        self.level = level
+        self.rng = rng
+        self.mtime = level.mtime
+        self.chunked = True
+        self.swarm = None  # Враги-массивы для больших уровней не используются
+        self.enemy_ticks = 0
+        self.width, self.height = 32 * level.cols, 32 * level.rows
+        self.chunk_cols = -(-level.cols // CHUNK_TILES)
+        self.chunk_rows = -(-level.rows // CHUNK_TILES)
+        self.all_sprites = pygame.sprite.Group()  # Только спрайты собранных кусков
+        self.things = SpatialGrid()
+        self.blocks = SpatialGrid()
+        self.enemies = list()
+        self.chunks = dict()  # (столбец, строка) -> LevelChunk
+        self.entities = dict()  # (столбец, строка) куска -> его сущности
+        self.jod_pos = None
+        for symbol, col, row in level.entities:
+            if symbol == 'J':
+                self.jod_pos = ((32 * col + 32), (32 * row))
+            else:
+                self.entities.setdefault((col // CHUNK_TILES, row // CHUNK_TILES), []).append((symbol, col, row))
+        self.spawned = set()  # Куски, враги которых уже были созданы из уровня
+        self.parked = dict()  # (столбец, строка) куска -> (класс, состояние) врагов, ждущих его сборки
+        self.nav = None
+        if any(symbol == 'c' for symbol, col, row in level.entities):  # Граф строится по собранным кускам
+            self.nav = self.nav_build()
+
+    def nav_build(self):
+        nav = level_nav(self.level, [Chaser(pygame.sprite.Group(), image_load('characters/enemy.png'),
+                                            2, 3, 0, 0, 1, 1, 2, 2, 0, 0, rng=self.rng)], NAV_REACH)
+        for key in self.chunks:
+            nav.prepare(key[0] * CHUNK_TILES, key[1] * CHUNK_TILES, CHUNK_TILES, CHUNK_TILES)
+        return nav
+
+    def chunk_of(self, rect):
+        size = 32 * CHUNK_TILES
+        return (min(max(rect.centerx // size, 0), self.chunk_cols - 1),
+                min(max(rect.centery // size, 0), self.chunk_rows - 1))
+
+    def stream(self, view):
+        # view - прямоугольник камеры на уровне. Возвращает True, если появились новые спрайты
+        size = 32 * CHUNK_TILES
+        wanted = {(col, row)
+                  for col in range(max(view.left // size - CHUNK_MARGIN, 0),
+                                   min((view.right - 1) // size + CHUNK_MARGIN, self.chunk_cols - 1) + 1)
+                  for row in range(max(view.top // size - CHUNK_MARGIN, 0),
+                                   min((view.bottom - 1) // size + CHUNK_MARGIN, self.chunk_rows - 1) + 1)}
+        for enemy in list(self.enemies):  # Ушедшие за собранные куски враги засыпают
+            if enemy.rect.top > self.height:
+                self.enemy_remove(enemy)  # Упал с уровня - больше не нужен
+            elif self.chunk_of(enemy.rect) not in wanted:
+                self.parked.setdefault(self.chunk_of(enemy.rect), []).append((type(enemy), enemy_state(enemy)))
+                self.enemy_remove(enemy)
+        for key in [key for key in self.chunks if key not in wanted]:
+            self.chunk_unload(key)
+        added = [key for key in sorted(wanted) if key not in self.chunks]
+        for key in added:
+            self.chunk_load(key)
+            if self.nav is not None:  # Пути к игроку ищутся на NAV_REACH от него - дальше собранных кусков
+                self.nav.prepare((key[0] - 2) * CHUNK_TILES, (key[1] - 2) * CHUNK_TILES,
+                                 5 * CHUNK_TILES, 5 * CHUNK_TILES)
+        return bool(added)
+
+    def chunk_load(self, key):
+        col, row = key[0] * CHUNK_TILES, key[1] * CHUNK_TILES
+        chunk = LevelChunk(key, pygame.Rect(32 * col, 32 * row, 32 * CHUNK_TILES, 32 * CHUNK_TILES))
+        for rect_col, rect_row, width, height in self.level.area_rects(col, row, CHUNK_TILES, CHUNK_TILES):
+            chunk.blocks.append(Solid(32 * rect_col, 32 * rect_row, 32 * width, 32 * height))
+        self.blocks.extend(chunk.blocks)
+        self.things.extend(chunk.blocks)
+        entities = self.entities.get(key, ())
+        if key in self.spawned:  # Первый раз враги берутся из уровня, потом - только уснувшие здесь
+            entities = [entity for entity in entities if entity[0] not in 'ec']
+        self.spawned.add(key)
+        self.chunk_fill(chunk, entities, self.parked.pop(key, ()))
+        self.chunks[key] = chunk
+
+    def chunk_fill(self, chunk, entities, parked=()):
+        # Спрайты сущностей и уснувшие враги в собранном куске
+        sprites = pygame.sprite.Group()
+        things, blocks, enemies = list(), list(), list()
+        entities_build(sprites, entities, things, blocks, enemies, self.rng)
+        for enemy_class, state in parked:
+            enemy = enemy_class(sprites, image_load('characters/enemy.png'),
+                                2, 3, 0, 0, 1, 1, 2, 2, 0, 0, rng=self.rng)
+            enemy_restore(enemy, state)
+            enemies.append(enemy)
+        for enemy in enemies:
+            if type(enemy) == Chaser:
+                enemy.nav = self.nav
+        chunk.sprites.extend(sprite for sprite in sprites if not isinstance(sprite, Enemy))
+        chunk.blocks.extend(blocks)
+        chunk.things.extend(things)
+        self.all_sprites.add(sprites)
+        self.blocks.extend(blocks)
+        self.things.extend(blocks)
+        self.things.extend(things)
+        for enemy in enemies:
+            self.enemies.append(enemy)
+            self.things.append(enemy)
+
+    def chunk_unload(self, key):
+        chunk = self.chunks.pop(key)
+        for block in chunk.blocks:
+            self.blocks.remove(block)
+            self.things.remove(block)
+        for thing in chunk.things:
+            self.things.remove(thing)
+        for sprite in chunk.sprites:
+            sprite.kill()
+
+    def enemy_remove(self, enemy):
+        self.enemies.remove(enemy)
+        self.things.remove(enemy)
+        enemy.kill()
+
+    def reload(self, level):
+        # Файл уровня изменился: в собранных кусках пересоздаются только спрайты и блоки
+        # из изменившихся клеток, в остальных меняются записи сущностей и уснувших врагов.
+        # False - у уровня другой размер, его надо собрать заново
+        if (level.cols, level.rows) != (self.level.cols, self.level.rows):
+            return False
+        changes = tile_changes(self.level, level)
+        self.level = level
+        self.mtime = level.mtime
+        if not changes:
+            return True
+        touched = dict()  # Ключ куска -> новые сущности в нем
+        for col, row in changes:
+            touched.setdefault((col // CHUNK_TILES, row // CHUNK_TILES), list())
+        for symbol, col, row in changed_entities(changes):
+            if symbol == 'J':
+                self.jod_pos = ((32 * col + 32), (32 * row))
+            else:
+                touched[(col // CHUNK_TILES, row // CHUNK_TILES)].append((symbol, col, row))
+        for enemy in [enemy for enemy in self.enemies if enemy.origin in changes]:
+            self.enemy_remove(enemy)
+        for key, parked in self.parked.items():
+            parked[:] = [(enemy_class, state) for enemy_class, state in parked if state.origin not in changes]
+        if self.nav is not None:
+            self.nav.update(changes)
+        elif any(symbol == 'c' for entities in touched.values() for symbol, col, row in entities):
+            self.nav = self.nav_build()
+        for key, entities in touched.items():
+            kept = [entity for entity in self.entities.get(key, ()) if (entity[1], entity[2]) not in changes]
+            self.entities[key] = sorted(kept + entities, key=lambda entity: (entity[2], entity[1]))
+            chunk = self.chunks.get(key)
+            if chunk is None:
+                if key in self.spawned:  # Новые враги куска ждут его сборки вместе с уснувшими
+                    enemies = list()
+                    entities_build(pygame.sprite.Group(), [entity for entity in entities if entity[0] in 'ec'],
+                                   list(), list(), enemies, self.rng)
+                    self.parked.setdefault(key, []).extend((type(enemy), enemy_state(enemy)) for enemy in enemies)
+                continue
+            gone = [thing for thing in chunk.blocks + chunk.things
+                    if type(thing) != Solid and thing.origin in changes]
+            removed, added = solids_patch(level, self.blocks, changes,
+                                          (key[0] * CHUNK_TILES, key[1] * CHUNK_TILES, CHUNK_TILES, CHUNK_TILES))
+            for thing in gone + removed:
+                if id(thing) in self.blocks.places:
+                    self.blocks.remove(thing)
+                self.things.remove(thing)
+                thing.kill()
+            chunk.blocks = [block for block in chunk.blocks if block not in gone and block not in removed] + added
+            chunk.things = [thing for thing in chunk.things if thing not in gone]
+            chunk.sprites = [sprite for sprite in chunk.sprites if sprite not in gone]
+            self.blocks.extend(added)
+            self.things.extend(added)
+            self.chunk_fill(chunk, entities)
+        for chunk in self.chunks.values():  # Фон куска рисует и тайлы соседей на CHUNK_PAD вокруг
+            area = chunk.rect.inflate(64 * CHUNK_PAD, 64 * CHUNK_PAD)
+            if any(area.collidepoint(32 * col, 32 * row) for col, row in changes):
+                chunk.layer = None
+        return True
+
+    def reset_enemies(self):
+        # Возврат на уровень: все собирается заново из файла уровня при следующем stream
+        for enemy in list(self.enemies):
+            self.enemy_remove(enemy)
+        for key in list(self.chunks):
+            self.chunk_unload(key)
+        self.spawned.clear()
+        self.parked.clear()
+
+    def chunk_layer(self, chunk):
+        # Фон, тайлы и неподвижные спрайты куска в порядке чтения уровня. Смотрятся и тайлы
+        # вокруг куска: подсказка или шип соседа может заходить на него
+        if chunk.layer is None:
+            layer = pygame.Surface(chunk.rect.size).convert()
+            layer.fill(BACKGROUND_COLOR)
+            background = image_load('background.png')
+            width, height = background.get_size()
+            for x in range(chunk.rect.left // width * width, chunk.rect.right, width):
+                for y in range(chunk.rect.top // height * height, chunk.rect.bottom, height):
+                    layer.blit(background, (x - chunk.rect.x, y - chunk.rect.y))
+            level = self.level
+            first_col, first_row = chunk.key[0] * CHUNK_TILES, chunk.key[1] * CHUNK_TILES
+            throwaway = pygame.sprite.Group()
+            for row in range(max(first_row - CHUNK_PAD, 0), min(first_row + CHUNK_TILES + CHUNK_PAD, level.rows)):
+                for col in range(max(first_col - CHUNK_PAD, 0), min(first_col + CHUNK_TILES + CHUNK_PAD, level.cols)):
+                    tile_id = level.tile(col, row)
+                    if tile_id in SOLID_TILES:
+                        image = image_load('blocks/block{0}.png'.format(tile_id))
+                        rect = pygame.Rect(32 * col, 32 * row, 32, 32)
+                    elif tile_id in SPRITE_TILES:
+                        sprites = list()
+                        entities_build(throwaway, [(SYMBOLS[tile_id], col, row)], sprites, sprites, sprites)
+                        image, rect = sprites[0].image, sprites[0].rect
+                    else:
+                        continue
+                    if rect.colliderect(chunk.rect):
+                        layer.blit(image, rect.move(-chunk.rect.x, -chunk.rect.y))
+            throwaway.empty()
+            chunk.layer = MEMORY.track(layer, 'surface', 'кусок {0} {1}'.format(self.name, chunk.key),
+                                       surface_size(layer))
+        return chunk.layer
+
+    def size(self):
+        total = (len(self.all_sprites) + len(self.things)) * SPRITE_BYTES
+        for enemy in self.enemies:
+            total += enemy.rect.w * enemy.rect.h // 8
+        for chunk in self.chunks.values():
+            if chunk.layer is not None:
+                total += surface_size(chunk.layer)
+        return total
+
+    def actors(self):
+        return [sprite for sprite in self.all_sprites if isinstance(sprite, (Enemy, Flag))]
+
+    def static_sprites(self):
+        return list()
+
+
+def scene_build(name, rng=RNG, swarm=False):
+    # Уровень в один экран собирается целиком, больший - кусками вокруг камеры
+    level = compiled_level_load(name)
+    if level.cols > SCREEN_COLS or level.rows > SCREEN_ROWS:
+        return ChunkedScene(name, rng, swarm)
+    return LevelScene(name, rng, swarm)
+
+
+def camera_view(rect, scene):
+    # Экран с игроком посередине, не выходящий за края уровня
+    view = pygame.Rect(0, 0, WIDTH, HEIGHT)
+    view.center = rect.center
+    view.left = max(min(view.left, scene.width - WIDTH), 0)
+    view.top = max(min(view.top, scene.height - HEIGHT), 0)
+    return view
+
+
+# Враг без спрайта: для сброса при возврате на уровень и для уснувших врагов выгруженных кусков.
+# Поля берутся по имени - новые поля не сдвигают старые
+EnemyState = namedtuple('EnemyState', ('rect', 'dx', 'dy', 'direction', 'air_time', 'cur_frame', 'frame_list',
+                                       'origin', 'carry_x', 'carry_y', 'steering'))
+
+
+def enemy_state(enemy):
+    steering = (enemy.goal, enemy.heading) if type(enemy) == Chaser else None
+    return EnemyState(tuple(enemy.rect), enemy.dx, enemy.dy, list(enemy.direction), enemy.air_time,
+                      enemy.cur_frame, enemy.frame_list, enemy.origin, enemy.carry_x, enemy.carry_y, steering)
 
 
-class Screen(pygame.sprite.Sprite):
+def enemy_restore(enemy, state):
+    enemy.rect.update(state.rect)
+    enemy.dx, enemy.dy, enemy.air_time, enemy.cur_frame = state.dx, state.dy, state.air_time, state.cur_frame
+    enemy.frame_list, enemy.origin = state.frame_list, state.origin
+    enemy.carry_x, enemy.carry_y = state.carry_x, state.carry_y
+    enemy.direction = list(state.direction)
+    if state.steering is not None:
+        enemy.goal, enemy.heading = state.steering
+    enemy.show_frame(enemy.cur_frame)
+
+
+def entity_record(entity, fields):
+    # Персонаж словарем из чисел, строк и списков - для снимка мира в файле записи.
+    # Показанный кадр хранится номером на листе: набор кадров мог смениться после показа
+    record = {field: getattr(entity, field) for field in fields if hasattr(entity, field)}
+    record['rect'] = list(entity.rect)
+    record['frames'] = next((name for name in FRAME_TABLES if getattr(entity, name, None) is entity.frame_list),
+                            FRAME_TABLES[0])
+    record['image'] = entity.frames.index(entity.image)
+    return record
+
+
+def entity_apply(entity, record):
+    for field, value in record.items():
+        if field in ('origin', 'goal') and value is not None:
+            value = tuple(value)  # Из JSON приходят списки, а узлы и клетки - ключи словарей
+        if field not in ('rect', 'frames', 'image'):
+            setattr(entity, field, value)
+    entity.rect.update(record['rect'])
+    entity.frame_list = getattr(entity, record['frames'])
+    entity.image = entity.frames[record['image']]
+    entity.mask = entity.sheet.masks[entity.image]
+    entity.dirty = max(entity.dirty, 1)
+
+
+def level_rng(seed, name):
+    # Враги уровня зависят только от зерна мира и имени уровня: собранный заново, взятый из кэша
+    # или собранный в фоне уровень одинаков, поэтому запись сессии повторяется с любого снимка
+    return random.Random('{0}/{1}'.format(seed, name))
+
+
+class SceneCache:
+    # Недавно собранные уровни по имени (LRU), чтобы возврат на уровень не пересобирал его.
+    # keep_enemies=False - враги при возврате встают на исходные места, True - остаются где были
+    def __init__(self, capacity=SCENE_CACHE_SIZE, max_bytes=SCENE_CACHE_LIMIT, keep_enemies=False):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.keep_enemies = keep_enemies
+        self.scenes = OrderedDict()  # Имя уровня -> (LevelScene, размер в байтах)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, name):
+        return name in self.scenes
+
+    def put(self, level_scene):
+        self.discard(level_scene.name)
+        size = level_scene.size()
+        self.scenes[level_scene.name] = (level_scene, size)
+        self.size += size
+        while self.scenes and (len(self.scenes) > self.capacity or self.size > self.max_bytes):
+            name, (old_scene, old_size) = self.scenes.popitem(last=False)
+            self.size -= old_size
+            LEVEL_LAYERS.pop(name, None)
+
+    def get(self, name):
+        # Забирает уровень из кэша: пока он на экране, вытеснять его нельзя
+        entry = self.scenes.pop(name, None)
+        if entry is not None:
+            self.size -= entry[1]
+            if entry[0].mtime != compiled_level_load(name).mtime:  # Файл уровня изменился
+                entry = None
+                LEVEL_LAYERS.pop(name, None)  # И фон запечен со старого файла
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        level_scene = entry[0]
+        if not self.keep_enemies:
+            level_scene.reset_enemies()
+        return level_scene
+
+    def discard(self, name):
+        entry = self.scenes.pop(name, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def stats(self):
+        return {'scenes': len(self.scenes), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+def level_prepare(name, rng, swarm=False):
+    # Работа фонового потока: собрать уровень и, если окно уже есть, запечь его фон
+    level_scene = scene_build(name, rng, swarm)
+    if not level_scene.chunked and pygame.display.get_surface() is not None:
+        level_layer(name, level_scene.static_sprites())
+    return level_scene
+
+
+def level_below(name):
+    if name not in LEVEL_LIST or LEVEL_LIST.index(name) == 0:
+        return None
+    return LEVEL_LIST[LEVEL_LIST.index(name) - 1]
+
+
+def level_above(name):
+    if name not in LEVEL_LIST or LEVEL_LIST.index(name) == len(LEVEL_LIST) - 1:
+        return None
+    return LEVEL_LIST[LEVEL_LIST.index(name) + 1]
+
+
+def level_neighbours(name):
+    return [other for other in (level_below(name), level_above(name)) if other is not None]
+
+
+class LevelPrefetcher:
+    # Собирает соседние уровни в фоновом потоке, пока игрок еще на текущем,
+    # чтобы переход был просто подменой готовых групп спрайтов
+    def __init__(self, scene_cache=None, swarm=False, seed=None):
+        self.scene_cache = scene_cache  # Уровни из кэша собирать заново не нужно
+        self.swarm = swarm
+        self.seed = seed  # Зерно мира, из него и имени получаются враги каждого уровня
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = dict()  # Имя уровня -> Future с LevelScene
+        self.ready = 0  # Переходов, для которых уровень уже был собран
+        self.waits = 0  # Переходов, которым пришлось ждать фоновую сборку
+        self.misses = 0  # Переходов на уровень, который не предзагружался
+        self.stale = 0  # Переходов, когда файл уровня изменился после фоновой сборки (--watch)
+
+    def prefetch(self, name):
+        neighbours = level_neighbours(name)
+        for other in list(self.futures):
+            if other not in neighbours:
+                self.futures.pop(other).cancel()
+        for neighbour in neighbours:
+            if self.scene_cache is not None and neighbour in self.scene_cache:
+                continue
+            if neighbour not in self.futures:
+                rng = level_rng(self.seed, neighbour)
+                self.futures[neighbour] = self.executor.submit(level_prepare, neighbour, rng, self.swarm)
+
+    def take(self, name):
+        future = self.futures.pop(name, None)
+        if future is None:
+            self.misses += 1
+            return scene_build(name, level_rng(self.seed, name), self.swarm)
+        if future.done():
+            self.ready += 1
+        else:
+            self.waits += 1
+        level_scene = future.result()
+        if level_scene.mtime != compiled_level_load(name).mtime:  # Файл уровня изменился, как в SceneCache
+            self.stale += 1
+            LEVEL_LAYERS.pop(name, None)  # Фон запечен со старого файла
+            return scene_build(name, level_rng(self.seed, name), self.swarm)
+        return level_scene
+
+    def stats(self):
+        return {'ready': self.ready, 'waits': self.waits, 'misses': self.misses, 'stale': self.stale}
+
+    def shutdown(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.futures.clear()
+        self.executor.shutdown(wait=True)
+
+
+def level_layer(name, sprites):
+    # Фон и неподвижные тайлы уровня рисуются в одну картинку один раз на уровень
+    layer = LEVEL_LAYERS.get(name)
+    if layer is None:
+        layer = pygame.Surface(SIZE).convert()
+        layer.fill(BACKGROUND_COLOR)
+        layer.blit(image_load('background.png'), (0, 0))
+        # Тайлы и неподвижные спрайты (шипы, подсказки - в порядке чтения уровня) рисуются
+        # вперемешку в порядке чтения, как раньше рисовались отдельные спрайты блоков
+        level = compiled_level_load(name)
+        sprites = iter(sprites)
+        for index, tile_id in enumerate(level.tiles):
+            if tile_id in SOLID_TILES:
+                row, col = divmod(index, level.cols)
+                layer.blit(image_load('blocks/block{0}.png'.format(tile_id)), (32 * col, 32 * row))
+            elif tile_id in SPRITE_TILES:
+                sprite = next(sprites)
+                layer.blit(sprite.image, sprite.rect)
+        LEVEL_LAYERS[name] = MEMORY.track(layer, 'surface', 'фон ' + name, surface_size(layer))
+    return layer
+
+
+class World:
+    # Игровой мир без окна: игрок, враги и уровень. Один вызов step - один кадр игры
+    def __init__(self, seed=None, level=START_LEVEL, prefetch=False, scene_cache=None, swarm=False,
+                 physics_rate=PHYSICS_RATE):
+        self.seed = random.getrandbits(32) if seed is None else seed  # Пишется в запись сессии
+        self.scale = BASE_RATE / physics_rate if physics_rate != BASE_RATE else 1  # Длина шага относительно обычного
+        self.swarm = swarm  # True - враги считаются массивами NumPy (EnemySwarm), а не по одному
+        self.scene_cache = scene_cache  # SceneCache с недавно посещенными уровнями или None
+        self.prefetcher = LevelPrefetcher(scene_cache, swarm, self.seed) if prefetch else None  # Сборка соседей в фоне
+        self.player_group = pygame.sprite.Group()  # Группа игрока
+        self.actors = dirty_group()  # Игрок, враги и флаг - всё, что перерисовывается поверх фона
+        self.layer = None  # Запеченный фон уровня, создается при первой отрисовке
+        self.level_scene = None
+        self.all_sprites = None  # Группа для всего остального(блоки, враги), берется из LevelScene
+        self.things = None
+        self.blocks = None
+        self.enemies = None
+        self.jod = Player(self.player_group, image_load('characters/Jods.png'),
+                          22, 1, -50, 0, 4, 4, 4, 4, 3, 3)  # Создание игрока
+        self.counter = 0  # Счетчик для анимации спрайтов (в шагах при BASE_RATE, то есть по времени)
+        self.previous = dict()  # Спрайт -> положение до последнего шага, для плавной отрисовки
+        self.steps = 0
+        self.profiler = None  # Profiler, если нужно замерять фазы кадра
+        self.status = None  # None - идет игра, 'dead' - упал с первого уровня, 'won' - победа
+        self.view = pygame.Rect(0, 0, WIDTH, HEIGHT)  # Видимая часть уровня (камера)
+        jod_pos = self.load_level(level)
+        if jod_pos is not None:
+            self.jod.rect.topleft = jod_pos
+        self.follow()
+
+    def load_level(self, name):
+        level_scene = None
+        if self.scene_cache is not None:
+            if self.level_scene is not None:
+                self.scene_cache.put(self.level_scene)  # Уходим с уровня - он остается собранным
+            level_scene = self.scene_cache.get(name)
+        if level_scene is None and self.prefetcher is not None:
+            level_scene = self.prefetcher.take(name)
+        if level_scene is None:
+            level_scene = scene_build(name, level_rng(self.seed, name), self.swarm)
+        self.level_scene = level_scene
+        self.all_sprites = level_scene.all_sprites
+        self.things = level_scene.things
+        self.blocks = level_scene.blocks
+        self.enemies = level_scene.enemies
+        if self.prefetcher is not None:
+            self.prefetcher.prefetch(name)
+        self.actors_refresh()
+        self.layer = None
+        self.previous.clear()  # Новый уровень - без сглаживания, иначе спрайты проедут через экран
+        return level_scene.jod_pos
+
+    def step(self, direction=(), jump=False):
+        jod = self.jod
+        profiler = self.profiler
+        swarm = self.level_scene.swarm
+        scale = self.scale
+        self.steps += 1
+        self.counter += scale
+        self.previous = {sprite: sprite.rect.topleft for sprite in self.actors if swarm is None or sprite is jod}
+        if swarm is not None:
+            swarm.previous = (swarm.x.copy(), swarm.y.copy())
+        if profiler is not None:
+            profiler.mark('sprite_change')
+        if jump:
+            jod.jump()
+        jod.sprite_change()  # Изменение активных фреймов
+        if swarm is None:  # У роя кадры выбираются при отрисовке
+            for enemy in self.enemies:
+                enemy.sprite_change()
+        if profiler is not None:
+            profiler.mark('animation')
+        if self.counter >= ANIMATION_STEPS:  # Скорость анимации спрайтов
+            jod.update()  # Анимация игрока
+            if swarm is None:
+                for enemy in self.enemies:
+                    enemy.update()  # Анимация врагов
+            else:
+                self.level_scene.enemy_ticks += 1
+            for block in self.blocks:
+                if type(block) == Flag:
+                    block.update()  # Анимация флага
+            self.counter -= ANIMATION_STEPS
+        if profiler is not None:
+            profiler.mark('move')
+        jod.move(direction, self.things, scale, self.level_scene.width)  # Движение
+        if swarm is None:
+            for enemy in self.enemies:
+                enemy.move(self.blocks, scale)  # Движение врагов
+                self.things.relocate(enemy)
+        else:
+            self.swarm_step(swarm)
+        if profiler is not None:
+            profiler.mark('transition')
+
+        if jod.rect.top >= self.level_scene.height:  # Если выходит за границу снизу
+            below = level_below(self.level_scene.name)
+            if below is not None:
+                self.load_level(below)  # Смена уровня
+                jod.rect.y = 0  # Перенос игрока вверх
+            else:  # Если уровень 1 (или отдельный уровень не из LEVEL_LIST)
+                if not jod.is_dead:
+                    jod.die()
+                    jod.dy = 0
+                self.status = 'dead'
+        elif jod.rect.bottom <= 0:  # Если выходит за границу сверху
+            above = level_above(self.level_scene.name)
+            if above is not None:
+                self.load_level(above)  # Смена уровня
+                jod.rect.y = self.level_scene.height  # Перенос игрока вниз
+        if jod.rect.right > self.level_scene.width:  # Если выходит за уровень справа
+            jod.rect.right = self.level_scene.width
+        if jod.rect.left < 0:  # Если выходит за экран слева
+            jod.rect.left = 0
+        self.follow()
+        if jod.won:
+            self.status = 'won'
+        return self.status
+
+    def reload_check(self):
+        # Файл текущего уровня изменился - уровень обновляется на месте по разнице тайлов,
+        # игрок остается где был и каким был. Возвращает True, если уровень обновлен
+        level_scene = self.level_scene
+        try:
+            level = compiled_level_load(level_scene.name)
+        except (OSError, UnicodeDecodeError):  # Файл сейчас записывается редактором
+            return False
+        if level.mtime == level_scene.mtime:
+            return False
+        if not level_scene.reload(level):  # Размер уровня изменился - собирается целиком
+            LEVEL_LAYERS.pop(level_scene.name, None)
+            level_scene = scene_build(level_scene.name, level_rng(self.seed, level_scene.name), self.swarm)
+            self.level_scene = level_scene
+            self.all_sprites = level_scene.all_sprites
+            self.things = level_scene.things
+            self.blocks = level_scene.blocks
+            self.enemies = level_scene.enemies
+        self.actors_refresh()
+        self.layer = None
+        self.previous.clear()
+        self.follow()
+        return True
+
+    def snapshot(self):
+        # Все, из чего restore продолжит игру так же, как она шла: только числа, строки и списки.
+        # Уровни собираются по зерну мира, поэтому из уровня хватает врагов текущего.
+        # Большие уровни (куски) и рой не сохраняются - None (анимация флага тоже, она только для глаз)
+        level_scene = self.level_scene
+        if level_scene.chunked or level_scene.swarm is not None:
+            return None
+        return {'steps': self.steps, 'counter': self.counter, 'status': self.status, 'level': level_scene.name,
+                'jod': entity_record(self.jod, PLAYER_FIELDS),
+                'enemies': [entity_record(enemy, ENEMY_FIELDS) for enemy in self.enemies]}
+
+    def restore(self, snapshot):
+        if snapshot['level'] != self.level_scene.name:
+            self.load_level(snapshot['level'])
+        self.steps, self.counter, self.status = snapshot['steps'], snapshot['counter'], snapshot['status']
+        entity_apply(self.jod, snapshot['jod'])
+        for enemy, record in zip(self.enemies, snapshot['enemies']):
+            entity_apply(enemy, record)
+            self.things.relocate(enemy)
+        self.previous.clear()
+        self.follow()
+
+    def follow(self):
+        # Камера за игроком; на больших уровнях вокруг нее собираются куски, дальние выгружаются
+        level_scene = self.level_scene
+        if not level_scene.chunked:
+            return
+        self.view = camera_view(self.jod.rect, level_scene)
+        if level_scene.stream(self.view):
+            self.actors_refresh()
+
+    def actors_refresh(self):
+        self.actors.empty()
+        self.actors.add(self.jod)
+        self.actors.add(self.level_scene.actors())
+        for enemy in self.enemies:
+            if type(enemy) == Chaser:
+                enemy.target = self.jod  # Преследователи идут за игроком этого мира
+
+    def swarm_step(self, swarm):
+        # Враги роя не лежат в things, поэтому касание игрока проверяется здесь, до их хода
+        jod = self.jod
+        if not jod.is_dead:
+            hits = swarm.touching(jod.rect).tolist()
+            if hits:
+                self.level_scene.sync_enemies(hits)
+                COLLISION_STATS.masks += len(hits)
+            for index in hits:
+                if pygame.sprite.collide_mask(jod, self.enemies[index]):
+                    jod.dy = 0
+                    jod.die()
+        swarm.step(self.scale)  # Движение всех врагов сразу
+
+    def close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown()
+
+    def stats(self):
+        # Счетчики кэшей: сколько раз ресурс или уровень нашелся готовым и сколько пришлось ждать
+        stats = {'assets': ASSETS.stats(), 'audio': {'bytes': audio_resident_bytes()}}
+        if self.scene_cache is not None:
+            stats['scenes'] = self.scene_cache.stats()
+        if self.prefetcher is not None:
+            stats['prefetch'] = self.prefetcher.stats()
+        return stats
+
+    def draw(self, canvas, full=False, alpha=1.0):
+        # Возвращает прямоугольники экрана, которые изменились.
+        # alpha - доля пути от положения до последнего шага физики к текущему, в котором рисовать спрайты
+        if self.level_scene.chunked:
+            return self.draw_view(canvas, alpha)
+        if self.layer is None:  # Новый уровень - перерисовывается весь экран
+            self.layer = level_layer(self.level_scene.name, self.level_scene.static_sprites())
+            self.actors.clear(canvas, self.layer)
+            full = True
+        if self.level_scene.swarm is not None:
+            self.level_scene.sync_enemies(alpha=alpha)
+        if full:
+            self.actors.repaint_rect(canvas.get_rect())
+        if alpha >= 1 or not self.previous:
+            return self.actors.draw(canvas)
+        current = dict()
+        for sprite, (x, y) in self.previous.items():
+            current[sprite] = sprite.rect.topleft
+            sprite.rect.topleft = (round(x + (sprite.rect.x - x) * alpha), round(y + (sprite.rect.y - y) * alpha))
+        rects = self.actors.draw(canvas)
+        for sprite, position in current.items():  # Физика продолжает с настоящих положений
+            sprite.rect.topleft = position
+        return rects
+
+    def draw_view(self, canvas, alpha=1.0):
+        # Большой уровень: камера двигается, поэтому экран рисуется целиком - видимые куски фона
+        # и спрайты, которые попадают в камеру
+        level_scene = self.level_scene
+        positions = dict()
+        for sprite in self.actors.sprites():
+            x, y = sprite.rect.topleft
+            if alpha < 1 and sprite in self.previous:
+                old_x, old_y = self.previous[sprite]
+                x, y = round(old_x + (x - old_x) * alpha), round(old_y + (y - old_y) * alpha)
+            positions[sprite] = pygame.Rect((x, y), sprite.rect.size)
+        view = camera_view(positions[self.jod], level_scene)
+        if level_scene.width < WIDTH or level_scene.height < HEIGHT:
+            canvas.fill(BACKGROUND_COLOR)
+        for chunk in level_scene.chunks.values():
+            if chunk.rect.colliderect(view):
+                canvas.blit(level_scene.chunk_layer(chunk), chunk.rect.move(-view.x, -view.y))
+        for sprite, rect in positions.items():
+            if rect.colliderect(view):
+                canvas.blit(sprite.image, rect.move(-view.x, -view.y))
+        return [canvas.get_rect()]
+
+    def run(self, inputs, max_steps=None):
+        # inputs - последовательность пар (направление, прыжок); останавливается на смерти или победе
+        for direction, jump in inputs:
+            if self.step(direction, jump) is not None:
+                break
+            if max_steps is not None and self.steps >= max_steps:
+                break
+        return self.status
+
+
+def dirty_group(*sprites):
+    group = pygame.sprite.LayeredDirty(*sprites)
+    group.set_timing_threshold(float('inf'))  # Не переключаться самому на полную перерисовку
+    return group
+
+
+class Renderer:
+    # Вывод кадра: pygame.display.update по изменившимся прямоугольникам или flip всего экрана
+    def __init__(self, canvas, full_flip=FULL_FLIP):
+        self.canvas = canvas
+        self.full_flip = full_flip
+        self.pixels = 0  # Сколько пикселей отправлено на экран в последнем кадре
+        self.total_pixels = 0
+        self.frames = 0
+
+    def present(self, rects):
+        screen_rect = self.canvas.get_rect()
+        if self.full_flip:
+            pygame.display.flip()
+            self.pixels = screen_rect.w * screen_rect.h
+        else:
+            rects = [screen_rect.clip(rect) for rect in rects]
+            pygame.display.update(rects)
+            self.pixels = sum(rect.w * rect.h for rect in rects)
+        self.total_pixels += self.pixels
+        self.frames += 1
+
+
+class Profiler:
+    # Время фаз каждого кадра (perf_counter_ns), скользящие p50/p95/p99 за последние кадры,
+    # число проверок столкновений и масок. Может рисовать таблицу поверх игры (F3)
+    # и писать замеры каждого кадра в CSV или, для файлов .json, в JSON Lines
+    def __init__(self, window=PROFILE_WINDOW, output=None, overlay=False):
+        self.samples = {phase: deque(maxlen=window) for phase in PROFILE_PHASES + ('frame', 'checks', 'masks')}
+        self.current = dict.fromkeys(PROFILE_PHASES, 0)
+        self.phase = None
+        self.phase_start = 0
+        self.frame_start = perf_counter_ns()
+        self.frames = 0
+        self.overlay = overlay
+        self.overlay_image = None
+        self.overlay_rect = pygame.Rect(0, 0, 0, 0)
+        self.font = None
+        self.file = None
+        self.writer = None
+        if output is not None:
+            self.file = open(output, mode='w', newline='')
+            if not output.endswith('.json'):
+                self.writer = csv.writer(self.file)
+                self.writer.writerow(('frame', 'level') + PROFILE_PHASES + ('frame_us', 'checks', 'masks', 'pixels'))
+
+    def mark(self, phase):
+        # Закрывает текущую фазу и начинает следующую
+        now = perf_counter_ns()
+        if self.phase is not None:
+            self.current[self.phase] += now - self.phase_start
+        self.phase = phase
+        self.phase_start = now
+
+    def end_frame(self, pixels=0, level=None):
+        # level - имя уровня на экране, для строки файла замеров
+        now = perf_counter_ns()
+        if self.phase is not None:
+            self.current[self.phase] += now - self.phase_start
+            self.phase = None
+        frame_time = now - self.frame_start
+        self.frame_start = now
+        self.frames += 1
+        for phase, spent in self.current.items():
+            self.samples[phase].append(spent)
+        self.samples['frame'].append(frame_time)
+        self.samples['checks'].append(COLLISION_STATS.checks)
+        self.samples['masks'].append(COLLISION_STATS.masks)
+        if self.file is not None:
+            values = [self.current[phase] // 1000 for phase in PROFILE_PHASES]
+            if self.writer is not None:
+                self.writer.writerow([self.frames, level] + values +
+                                     [frame_time // 1000, COLLISION_STATS.checks, COLLISION_STATS.masks, pixels])
+            else:
+                row = dict(zip(PROFILE_PHASES, values), frame=self.frames, level=level,
+                           frame_us=frame_time // 1000, checks=COLLISION_STATS.checks,
+                           masks=COLLISION_STATS.masks, pixels=pixels)
+                self.file.write(json.dumps(row) + '\n')
+        for phase in self.current:
+            self.current[phase] = 0
+        COLLISION_STATS.reset()
+        if self.overlay and self.frames % 15 == 0:
+            self.overlay_image = None  # Таблица обновляется раз в 15 кадров
+
+    def percentiles(self, name):
+        values = sorted(self.samples[name])
+        if not values:
+            return 0, 0, 0
+        return tuple(values[min(len(values) - 1, len(values) * p // 100)] for p in (50, 95, 99))
+
+    def draw(self, canvas, stats=None):
+        # Рисует таблицу перцентилей и возвращает ее прямоугольник.
+        # stats - функция, возвращающая счетчики кэшей (World.stats), они выводятся под таблицей
+        if self.overlay_image is None:
+            if self.font is None:
+                self.font = pygame.font.Font(None, 20)
+            rows = [('фаза, мс', 'p50', 'p95', 'p99')]
+            for name in PROFILE_PHASES + ('frame',):
+                rows.append((name,) + tuple('{0:.2f}'.format(value / 1e6) for value in self.percentiles(name)))
+            for name in ('checks', 'masks'):
+                rows.append((name,) + tuple(str(value) for value in self.percentiles(name)))
+            counters = [(name, self.font.render(text, True, (255, 255, 255)))
+                        for name, text in stats_rows(stats())] if stats is not None else []
+            width = max([300] + [76 + text.get_width() for name, text in counters])
+            self.overlay_image = pygame.Surface((width, 16 * (len(rows) + len(counters)) + 8), pygame.SRCALPHA)
+            MEMORY.track(self.overlay_image, 'surface', 'профилировщик', surface_size(self.overlay_image))
+            self.overlay_image.fill((0, 0, 0, 170))
+            for index, row in enumerate(rows):
+                self.overlay_image.blit(self.font.render(row[0], True, (255, 255, 255)), (6, 4 + 16 * index))
+                for column, cell in enumerate(row[1:]):  # Числа выравниваются по правому краю колонки
+                    text = self.font.render(cell, True, (255, 255, 255))
+                    self.overlay_image.blit(text, (170 + 60 * column - text.get_width(), 4 + 16 * index))
+            for index, (name, text) in enumerate(counters, len(rows)):
+                self.overlay_image.blit(self.font.render(name, True, (255, 255, 255)), (6, 4 + 16 * index))
+                self.overlay_image.blit(text, (76, 4 + 16 * index))
+            self.overlay_rect = self.overlay_image.get_rect(topleft=(8, 8))
+        canvas.blit(self.overlay_image, self.overlay_rect)
+        return self.overlay_rect
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def stats_rows(stats):
+    # World.stats строками (имя, значения) - для таблицы F3 и печати, когда игра кончается
+    rows = list()
+    for name, values in stats.items():
+        rows.append((name, '  '.join('{0} {1}'.format(key, '{0} КБ'.format(value // 1024) if key == 'bytes' else value)
+                                     for key, value in values.items())))
+    return rows
+
+
+def loading_draw(canvas, done, total):
+    # Экран загрузки без картинок (их как раз и читаем): полоса прогресса по центру.
+    # Весь экран заливается один раз в main, дальше обновляется только полоса
+    pygame.event.pump()  # Чтобы система не сочла окно зависшим
+    bar = pygame.Rect(0, 0, WIDTH // 3, 24)
+    bar.center = (WIDTH // 2, HEIGHT // 2)
+    canvas.fill(BACKGROUND_COLOR, bar)
+    pygame.draw.rect(canvas, (255, 255, 255), bar, 2)
+    pygame.draw.rect(canvas, (255, 255, 255), (bar.x + 4, bar.y + 4, (bar.width - 8) * done // max(total, 1), 16))
+    pygame.display.update(bar)
+
+
+def headless_init():
+    # Запуск pygame без окна и звука (драйверы SDL dummy) для автоматических прогонов
+    global MUTED
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    MUTED = True
+    pygame.init()
+    pygame.display.set_mode(SIZE)
+
+
+class Screen(pygame.sprite.DirtySprite):
     def __init__(self, special_group, name):
         super().__init__(special_group)
-        self.image = image_load('menu\\{0}'.format(name))
+        self.image = image_load('menu/{0}'.format(name))
         self.rect = self.image.get_rect()
         self.rect.topleft = (0, 0)
 
 
-class Button(pygame.sprite.Sprite):
+class Button(pygame.sprite.DirtySprite):
     def __init__(self, special_group, image, pos):
         super().__init__(special_group)
-        self.image = image_load('menu\\{0}'.format(image))
+        self.image = image_load('menu/{0}'.format(image))
         self.rect = self.image.get_rect()
         self.rect.topleft = pos
 
@@ -426,7 +1996,7 @@ def win_init(special_group):
 class Flag(AnimatedSprite):
     def __init__(self, all_sprites, image, columns, rows, pos_x, pos_y, is_fake=False):
         super().__init__(all_sprites, image, columns, rows)
-        self.image = image_load('flag.png')
+        self.image = image
         self.rect = self.image.get_rect()
         self.rect.topleft = (pos_x, pos_y)
         self.is_fake = is_fake
@@ -441,166 +2011,296 @@ class Instruction(pygame.sprite.Sprite):
         self.is_fake = is_fake
 
 
-def main():
-    direction = list()
-    pygame.init()
-    pygame.mixer.init()
-    backgrounds = pygame.sprite.Group()  # Группа фона
-    background = pygame.sprite.Sprite(backgrounds)  # Фон
-    player_group = pygame.sprite.Group()  # Группа игрока
-    special_group = pygame.sprite.Group()  # Группа для меню и экранов
-    all_sprites = pygame.sprite.Group()  # Группа для всего остального(блоки, враги)
-    music = sound_load('music\\menu.wav')
-    music.set_volume(0.3)
-    music.play(-1)
-    death_music = sound_load('music\\death.wav')
-    win_music = sound_load('music\\win.wav')
-    pygame.display.set_caption('игра')
-    canvas = pygame.display.set_mode(SIZE)
-    background.image = image_load('background.png')
-    background.rect = background.image.get_rect()
-    background.rect.topleft = (0, 0)
-    jod = Player(player_group, image_load('characters\\Jods.png'),
-                 22, 1, -50, 0, 4, 4, 4, 4, 3, 3)  # Создание игрока
-    enemies, blocks, things, jod_pos = level_change(all_sprites, 'level1.txt', jod, blocks=list(),
-                                                    enemies=list(), things=list())
-    jod.rect.topleft = jod_pos
-    clock = pygame.time.Clock()
-    counter = 0  # Счетчик для анимации спрайтов
-    menu, play_button, quit_button = menu_init(special_group)
-    retry_button = pygame.rect
-    quit_death_button = pygame.rect
-
-    menu_running = True
-    running = True
-    death_running = False
-    win_running = False
-
-    while running:
-        while menu_running:  # Запуск меню
-            for event in pygame.event.get():
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    if play_button.rect.collidepoint(event.pos[0], event.pos[1]):
-                        menu_running = False
-                    if quit_button.rect.collidepoint(event.pos[0], event.pos[1]):
-                        menu_running = False
-                        running = False
-                if event.type == pygame.QUIT:
-                    menu_running = False
-                    running = False
-            special_group.draw(canvas)
-            pygame.display.flip()
-        special_group.empty()
-        counter += 1
+class StaticState:
+    # Экран-картинка с кнопками. Ждет событий в pygame.event.wait, а не крутит цикл,
+    # и перерисовывает только изменившееся - простаивающая игра почти не тратит процессор
+    def __init__(self, game):
+        self.game = game
+        self.group = dirty_group()
+        self.buttons = list()  # (кнопка, что сделать при нажатии)
+
+    def build(self, group):
+        return list()
+
+    def enter(self):
+        self.group.empty()
+        self.buttons = self.build(self.group)
+        self.group.repaint_rect(self.game.canvas.get_rect())
+
+    def click(self, pos):
+        for button, action in self.buttons:
+            if button.rect.collidepoint(pos[0], pos[1]):
+                return action
+        return None
+
+    def frame(self):
+        game = self.game
+        rects = self.group.draw(game.canvas)
+        if rects:
+            game.renderer.present(rects)
+            if game.startup is not None:
+                game.startup_log()
+        events = [pygame.event.wait(IDLE_TIMEOUT)]  # Без событий спим до таймаута
+        events.extend(pygame.event.get())
+        for event in events:
+            if event.type == pygame.QUIT:
+                return 'quit'
+            if event.type == pygame.MOUSEBUTTONDOWN:
+                action = self.click(event.pos)
+                if action is not None:
+                    return action
+            if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):  # Окно открылось из-под другого
+                self.group.repaint_rect(game.canvas.get_rect())
+        return None
+
+
+class MenuState(StaticState):
+    def build(self, group):
+        menu, play_button, quit_button = menu_init(group)
+        return [(play_button, 'playing'), (quit_button, 'quit')]
+
+    def enter(self):
+        super().enter()
+        music_play('music/menu.wav', volume=0.3)
+
+
+class DeathState(StaticState):
+    def build(self, group):
+        death, retry_button, quit_button = death_screen(group)
+        return [(retry_button, 'retry'), (quit_button, 'quit')]
+
+    def enter(self):
+        super().enter()
+        audio_stop()
+        music_play('music/death.wav')
+
+    def click(self, pos):
+        action = super().click(pos)
+        if action == 'retry':
+            self.game.new_world()  # Новый игрок и первый уровень
+            audio_stop()
+            music_play('music/menu.wav', volume=0.3)
+            return 'playing'
+        return action
+
+
+class WinState(StaticState):
+    def build(self, group):
+        win, quit_button = win_init(group)
+        return [(quit_button, 'quit')]
+
+    def enter(self):
+        super().enter()
+        audio_stop()
+        music_play('music/win.wav')
+
+
+class PlayingState:
+    # Сама игра. Физика идет шагами постоянной длины (game.physics_rate в секунду), сколько их
+    # набежало с прошлого кадра; отрисовка - со своей частотой (FPS), спрайты между двумя шагами
+    def __init__(self, game):
+        self.game = game
+        self.direction = list()
+        self.jump = False  # Прыжок ждет ближайшего шага физики
+        self.clock = pygame.time.Clock()
+        self.full = True
+        self.step_ns = 10 ** 9 // game.physics_rate
+        self.accumulator = 0  # Сколько нс игрового времени еще не отсчитано шагами
+        self.last = 0
+        self.watched = 0  # Когда последний раз проверялся файл уровня (--watch)
+
+    def enter(self):
+        self.direction = list()
+        self.jump = False
+        self.full = True  # Поверх экрана меню уровень рисуется целиком
+        self.accumulator = self.step_ns  # Первый кадр сразу делает шаг
+        self.last = perf_counter_ns()
+
+    def frame(self):
+        game = self.game
+        world = game.world
+        profiler = game.profiler
+        direction = self.direction
+        profiler.mark('events')
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
-                running = False
+                return 'quit'
 
             # Нажатия на кнопки
             if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_F3:  # Таблица профилировщика
+                    profiler.overlay = not profiler.overlay
+                    world.actors.repaint_rect(profiler.overlay_rect)
                 if event.key == pygame.K_z:
-                    jod.jump()
+                    self.jump = True
                 if event.key == pygame.K_RIGHT:
                     direction.append('right')
                 if event.key == pygame.K_LEFT:
                     direction.append('left')
             if event.type == pygame.KEYUP:
-                if event.key == pygame.K_RIGHT:
+                if event.key == pygame.K_RIGHT and 'right' in direction:
                     direction.pop(direction.index('right'))
-                if event.key == pygame.K_LEFT:
+                if event.key == pygame.K_LEFT and 'left' in direction:
                     direction.pop(direction.index('left'))
             # Нажатия на кнопки
 
-        jod.sprite_change()  # Изменение активных фреймов
-        for enemy in enemies:
-            enemy.sprite_change()
-        if counter % 8 == 0:  # Скорость анимации спрайтов
-            jod.update()  # Анимация игрока
-            for enemy in enemies:
-                enemy.update()  # Анимация врагов
-            for block in blocks:
-                if type(block) == Flag:
-                    block.update()  # Анимация флага
-            counter = 0
-        jod.move(direction, things)  # Движение
-        for enemy in enemies:
-            enemy.move(blocks)  # Движение врагов
+        now = perf_counter_ns()
+        if game.watch and now - self.watched >= RELOAD_INTERVAL * 10 ** 6:
+            self.watched = now
+            if world.reload_check():
+                self.full = True
+        self.accumulator = min(self.accumulator + now - self.last, MAX_STEPS * self.step_ns)
+        self.last = now
+        while self.accumulator >= self.step_ns:
+            self.accumulator -= self.step_ns
+            if game.recorder is not None:
+                game.recorder.record(direction, self.jump)
+            status = world.step(direction, self.jump)
+            self.jump = False
+            if status == 'dead':  # Упал ниже первого уровня
+                return 'death'
+            if status == 'won':
+                return 'win'
+        profiler.mark('draw')
+        if profiler.overlay:
+            world.actors.repaint_rect(profiler.overlay_rect)  # Под таблицей перерисовать уровень
+        rects = world.draw(game.canvas, game.renderer.full_flip or self.full,
+                           self.accumulator / self.step_ns)  # Отрисовка уровня и всех спрайтов
+        self.full = False
+        if profiler.overlay:
+            rects.append(profiler.draw(game.canvas, world.stats))
+        game.renderer.present(rects)
+        profiler.mark('tick')
+        self.clock.tick(game.fps)  # При 0 - без предела
+        profiler.end_frame(game.renderer.pixels, world.level_scene.name)
+        return None
 
-        if jod.rect.top >= HEIGHT:  # Если выходит за границу снизу
-            if not CURRENT_LEVEL == 'level1.txt':
-                level_change(all_sprites, LEVEL_LIST[LEVEL_LIST.index(CURRENT_LEVEL) - 1], jod,
-                             things, blocks, enemies)  # Смена уровня
-                jod.rect.y = 0  # Перенос игрока вверх
-            else:  # Если уровень 1
-                if not jod.is_dead:
-                    jod.die()
-                    jod.dy = 0
-                death, retry_button, quit_death_button = death_screen(special_group)
-                death_running = True
-                pygame.mixer.stop()
-                death_music.play(-1)
 
-        elif jod.rect.bottom <= 0:  # Если выходит за границу сверху
-            if not CURRENT_LEVEL == 'level6.txt':
-                level_change(all_sprites, LEVEL_LIST[LEVEL_LIST.index(CURRENT_LEVEL) + 1],
-                             jod, things, blocks, enemies)  # Смена уровня
-                jod.rect.y = HEIGHT  # Перенос игрока вниз
-        if jod.rect.right > WIDTH:  # Если выходит за экран справа
-            jod.rect.right = WIDTH
-        if jod.rect.left < 0:  # Если выходит за экран слева
-            jod.rect.left = 0
-        while death_running:  # Если умер
-            for event in pygame.event.get():
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    if retry_button.rect.collidepoint(event.pos[0], event.pos[1]):  # при нажатии на Retry
-                        death_running = False
-                        player_group.empty()
-                        all_sprites.empty()
-                        jod = Player(player_group, image_load('characters\\Jods.png'),
-                                     22, 1, -50, 0, 4, 4, 4, 4, 3, 3)  # Создание игрока
-                        enemies, blocks, things, jod_pos = level_change(all_sprites, 'level1.txt', jod,
-                                                                        blocks=list(), enemies=list(), things=list())
-                        jod.rect.topleft = jod_pos
-                        jod.is_dead = False
-                        direction = list()
-                        pygame.mixer.stop()
-                        music = sound_load('music\\menu.wav')
-                        music.set_volume(0.3)
-                        music.play(-1)
-                    if quit_death_button.rect.collidepoint(event.pos[0], event.pos[1]):
-                        death_running = False
-                        running = False
-                if event.type == pygame.QUIT:
-                    death_running = False
-                    running = False
-            special_group.draw(canvas)
-            pygame.display.flip()
-        if jod.won:  # Если победил
-            win_running = True
-            win, quit_button = win_init(special_group)
-            pygame.mixer.stop()
-            win_music.play(-1)
-        while win_running:  # Экран победы
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    win_running = False
-                    running = False
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    if quit_button.rect.collidepoint(event.pos[0], event.pos[1]):
-                        win_running = False
-                        running = False
-            special_group.draw(canvas)
-            pygame.display.flip()
-        canvas.fill((70, 70, 170))
-        # Отрисовка всех спрайтов
-        backgrounds.draw(canvas)
-        player_group.draw(canvas)
-        all_sprites.draw(canvas)
-        pygame.display.flip()
-        # Отрисовка всех спрайтов
-        clock.tick(FPS)
+class Game:
+    # Машина состояний: меню, игра, смерть, победа. frame текущего состояния возвращает
+    # имя следующего, 'quit' или None, если остаемся
+    def __init__(self, canvas, renderer, profiler, swarm=False, physics_rate=PHYSICS_RATE, fps=FPS, watch=False,
+                 record=None, stats=False):
+        self.canvas = canvas
+        self.renderer = renderer
+        self.profiler = profiler
+        self.swarm = swarm
+        self.physics_rate = physics_rate
+        self.fps = fps
+        self.watch = watch  # Подхватывать правки файла текущего уровня на лету
+        self.record = record  # Файл записи сессии (replay.py); каждый повтор после смерти - в следующий файл
+        self.recorder = None
+        self.stats = stats  # Печатать время запуска и счетчики кэшей каждой игры (--stats или --profile)
+        self.worlds = 0
+        self.world = None
+        self.snapshots = dict()  # Имя состояния -> снимок памяти при прошлом входе в него (--memory)
+        self.startup = None  # Время фаз запуска в нс, пока не показан первый кадр (задает main)
+        self.started = 0
+        self.new_world()
+        self.states = {'menu': MenuState(self), 'playing': PlayingState(self),
+                       'death': DeathState(self), 'win': WinState(self)}
+
+    def new_world(self):
+        if self.world is not None:
+            self.world.close()
+            self.world_log()
+        if self.recorder is not None:
+            self.recorder.close()
+        self.world = World(prefetch=True, scene_cache=SceneCache(), swarm=self.swarm, physics_rate=self.physics_rate)
+        self.world.profiler = self.profiler
+        self.worlds += 1
+        if self.record is not None:
+            base, extension = os.path.splitext(self.record)
+            path = self.record if self.worlds == 1 else '{0}-{1}{2}'.format(base, self.worlds, extension)
+            self.recorder = Recorder(path, self.world, self.physics_rate, self.swarm)
+
+    def run(self, name='menu'):
+        state = self.states[name]
+        state.enter()
+        self.memory_check(name)
+        while True:
+            name = state.frame()
+            if name == 'quit':
+                break
+            if name is not None:
+                state = self.states[name]
+                state.enter()
+                self.memory_check(name)
+        self.world.close()
+        self.world_log()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def world_log(self):
+        # Игра кончилась (выход или повтор после смерти) - печатаются счетчики кэшей ее мира
+        if not self.stats:
+            return
+        print('Кэши, игра {0}: '.format(self.worlds) + '; '.join('{0}: {1}'.format(name, text)
+                                                              for name, text in stats_rows(self.world.stats())))
+
+    def startup_log(self):
+        # Первый кадр на экране - запуск закончен, время его фаз печатается
+        self.startup['first_frame'] = perf_counter_ns() - self.started
+        if self.stats:
+                print('Запуск, мс: ' + ', '.join('{0} {1:.1f}'.format(name, spent / 1e6)
+                                             for name, spent in self.startup.items()))
+        self.startup = None
+
+    def memory_check(self, name):
+        # При включенном учете памяти печатает, что прибавилось с прошлого входа в то же состояние:
+        # после десятка повторов с экрана смерти живых картинок и звуков должно быть столько же
+        if not MEMORY.enabled:
+            return
+        snapshot = MEMORY.snapshot()
+        previous = self.snapshots.get(name)
+        if previous is not None:
+            print('память, вход в {0}:'.format(name))
+            print(diff_report(previous, snapshot))
+        self.snapshots[name] = snapshot
+
+
+def main(profile_output=None, overlay=False, full_flip=FULL_FLIP, swarm=False, physics_rate=PHYSICS_RATE, fps=FPS,
+         watch=False, memory=False, record=None, stats=False):
+    # Запуск: окно с полосой загрузки, картинки и звуки меню и первого уровня читаются в потоках,
+    # потом собирается мир. С --stats время фаз печатается, когда на экране первый кадр меню
+    started = perf_counter_ns()
+    MEMORY.enabled = memory
+    pygame.init()
+    pygame.mixer.init()
+    pygame.display.set_caption('игра')
+    canvas = pygame.display.set_mode(SIZE)
+    renderer = Renderer(canvas, full_flip)
+    profiler = Profiler(output=profile_output, overlay=overlay)
+    canvas.fill(BACKGROUND_COLOR)
+    pygame.display.flip()
+    startup = {'init': perf_counter_ns() - started}
+    mark = perf_counter_ns()
+    images, sounds = startup_manifest(START_LEVEL)
+    startup['manifest'] = perf_counter_ns() - mark
+    startup.update(assets_preload(images, sounds, lambda done, total: loading_draw(canvas, done, total)))
+    mark = perf_counter_ns()
+    stats = stats or profile_output is not None
+    game = Game(canvas, renderer, profiler, swarm, physics_rate, fps, watch, record, stats)
+    startup['world'] = perf_counter_ns() - mark
+    game.startup, game.started = startup, started
+    game.run('menu')
+    profiler.close()
     pygame.quit()
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Приключения Джода')
+    parser.add_argument('--profile', default=None, help='писать время фаз каждого кадра в CSV (или .json)')
+    parser.add_argument('--overlay', action='store_true', help='сразу показать таблицу профилировщика (F3)')
+    parser.add_argument('--full-flip', action='store_true', help='перерисовывать весь экран каждый кадр')
+    parser.add_argument('--swarm', action='store_true', help='считать врагов массивами NumPy (для уровней с толпой)')
+    parser.add_argument('--physics-rate', type=int, default=PHYSICS_RATE, help='шагов физики в секунду')
+    parser.add_argument('--fps', type=int, default=FPS, help='предел кадров отрисовки в секунду, 0 - без предела')
+    parser.add_argument('--watch', action='store_true', help='подхватывать правки файла уровня без перезапуска')
+    parser.add_argument('--memory', action='store_true',
+                        help='печатать прирост картинок, масок и звуков между экранами')
+    parser.add_argument('--record', default=None, help='записывать нажатия и снимки мира в файл (смотреть replay.py)')
+    parser.add_argument('--stats', action='store_true', help='печатать время запуска и счетчики кэшей каждой игры')
+    args = parser.parse_args()
+    main(args.profile, args.overlay, args.full_flip or FULL_FLIP, args.swarm, args.physics_rate, args.fps, args.watch,
+         args.memory, args.record, args.stats)
@@ -0,0 +1,233 @@
+import os
+import struct
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Компиляция текстовых уровней data/levels/*.txt в компактный двоичный формат.
+# Текстовый файл остается исходником, скомпилированный лежит в data/levels/compiled
+# и пересобирается сам, когда у исходника меняется время изменения.
+
+LEVEL_DIR = os.path.join('data', 'levels')
+COMPILED_DIR = os.path.join(LEVEL_DIR, 'compiled')
+MAGIC = b'JLVL'
+VERSION = 2  # Меняется вместе с TILE_IDS и раскладкой: копии старых версий пересобираются
+HEADER = struct.Struct('<4sHqHHHH')  # метка, версия, mtime исходника, столбцы, строки, сущности, прямоугольники
+ENTITY = struct.Struct('<BHH')  # номер тайла, столбец, строка
+RECT = struct.Struct('<HHHH')  # столбец, строка, ширина, высота (в тайлах)
+
+# Символ в текстовом уровне -> номер тайла
+TILE_IDS = {'#': 0, '1': 1, '2': 2, '3': 3, '4': 4, '5': 5, '6': 6,
+            'i': 7, 's': 8, 'e': 9, 'f': 10, 'r': 11, 'J': 12, 'c': 13}
+SYMBOLS = {tile_id: symbol for symbol, tile_id in TILE_IDS.items()}
+SOLID_TILES = frozenset(range(1, 7))  # Обычные блоки, из них собираются прямоугольники столкновений
+ENTITY_TILES = frozenset(TILE_IDS[symbol] for symbol in 'isefrJc')
+TILE_TABLE = bytes(TILE_IDS.get(chr(code), 0) for code in range(256))  # Для bytes.translate: код символа -> тайл
+
+LOADED = dict()  # Имя уровня -> (mtime исходника, уровень)
+WRITER = ThreadPoolExecutor(max_workers=1)  # Переписывает копии правленых уровней в фоне, по очереди правок
+
+
+class CompiledLevel:
+    def __init__(self, name, mtime, cols, rows, tiles, entities, rects):
+        self.name = name
+        self.mtime = mtime
+        self.cols = cols
+        self.rows = rows
+        self.tiles = tiles  # bytes, cols * rows номеров тайлов построчно
+        self.entities = entities  # [(символ, столбец, строка)] в порядке чтения текста
+        self.rects = rects  # [(столбец, строка, ширина, высота)] слитые блоки
+
+    def tile(self, col, row):
+        if 0 <= col < self.cols and 0 <= row < self.rows:
+            return self.tiles[row * self.cols + col]
+        return 0
+
+    def area_rects(self, col, row, width, height):
+        # Слитые блоки только внутри части уровня - для уровней, которые собираются кусками
+        return merge_solids(self.tiles, self.cols, self.rows, (col, row, width, height))
+
+
+def source_path(name):
+    return os.path.join(LEVEL_DIR, name)
+
+
+def compiled_path(name):
+    return os.path.join(COMPILED_DIR, os.path.splitext(name)[0] + '.lvl')
+
+
+def parse_text(text):
+    lines = text.split('\n')
+    while lines and not lines[-1]:
+        lines.pop()
+    cols = max((len(line) for line in lines), default=0)
+    # Символ за символом: не-latin-1 символ становится '?', а неизвестные символы - пустыми клетками
+    rows = [line.encode('latin-1', 'replace').translate(TILE_TABLE).ljust(cols, b'\x00') for line in lines]
+    return cols, len(lines), b''.join(rows)
+
+
+def merge_solids(tiles, cols, rows, area=None, cells=None):
+    # Жадное слияние: расширяем прямоугольник вправо, пока идут блоки, потом вниз,
+    # пока вся следующая строка под ним из блоков. area=(столбец, строка, ширина, высота) -
+    # сливать только внутри этой части, прямоугольники не выходят за ее границы.
+    # cells - если блоки есть только в этих клетках, обходятся только они, а не вся area
+    left, top, right, bottom = 0, 0, cols, rows
+    if area is not None:
+        left, top = max(area[0], 0), max(area[1], 0)
+        right, bottom = min(area[0] + area[2], cols), min(area[1] + area[3], rows)
+    used = bytearray(cols * rows)
+    rects = list()
+
+    def free(col, row):
+        index = row * cols + col
+        return tiles[index] in SOLID_TILES and not used[index]
+    if cells is None:
+        starts = ((col, row) for row in range(top, bottom) for col in range(left, right))
+    else:  # В том же порядке чтения, что и обход area
+        starts = sorted(((col, row) for col, row in cells if left <= col < right and top <= row < bottom),
+                        key=lambda cell: (cell[1], cell[0]))
+    for col, row in starts:
+        if not free(col, row):
+            continue
+        width = 1
+        while col + width < right and free(col + width, row):
+            width += 1
+        height = 1
+        while row + height < bottom and all(free(c, row + height) for c in range(col, col + width)):
+            height += 1
+        for r in range(row, row + height):
+            used[r * cols + col:r * cols + col + width] = b'\x01' * width
+        rects.append((col, row, width, height))
+    return rects
+
+
+def entities_of(tiles, cols, rows):
+    return [(SYMBOLS[tiles[row * cols + col]], col, row) for row in range(rows) for col in range(cols)
+            if tiles[row * cols + col] in ENTITY_TILES]
+
+
+def encode(mtime, cols, rows, tiles, entities, rects):
+    parts = [HEADER.pack(MAGIC, VERSION, mtime, cols, rows, len(entities), len(rects)), tiles]
+    parts.extend(ENTITY.pack(TILE_IDS[symbol], col, row) for symbol, col, row in entities)
+    parts.extend(RECT.pack(*rect) for rect in rects)
+    return b''.join(parts)
+
+
+def decode(name, data):
+    magic, version, mtime, cols, rows, entity_count, rect_count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('{0}: неизвестный формат уровня'.format(name))
+    offset = HEADER.size
+    tiles = bytes(data[offset:offset + cols * rows])
+    offset += cols * rows
+    entities = [(SYMBOLS[tile_id], col, row) for tile_id, col, row in
+                ENTITY.iter_unpack(data[offset:offset + entity_count * ENTITY.size])]
+    offset += entity_count * ENTITY.size
+    rects = list(RECT.iter_unpack(data[offset:offset + rect_count * RECT.size]))
+    return CompiledLevel(name, mtime, cols, rows, tiles, entities, rects)
+
+
+def level_save(name, data):
+    path = compiled_path(name)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Пишется во временный файл и подменяет копию целиком: прерванная сборка или фоновый поток,
+        # читающий уровень в это время, не увидят записанный наполовину файл
+        handle, temporary = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(handle, mode='wb') as file:
+                file.write(data)
+            os.replace(temporary, path)
+        except OSError:
+            os.remove(temporary)
+            raise
+    except OSError:
+        pass  # Нет прав на запись - работаем с уровнем в памяти
+
+
+def compile_level(name):
+    # Собирает уровень из текста и сохраняет двоичную копию рядом
+    source = source_path(name)
+    mtime = os.stat(source).st_mtime_ns
+    with open(source, mode='r') as file:
+        cols, rows, tiles = parse_text(file.read())
+    data = encode(mtime, cols, rows, tiles, entities_of(tiles, cols, rows), merge_solids(tiles, cols, rows))
+    level_save(name, data)
+    return decode(name, data)
+
+
+def rects_patch(tiles, cols, rows, rects, changed):
+    # Слитые блоки после правки клеток changed: прямоугольники, задевшие их, убираются,
+    # а их клетки вместе с changed сливаются заново. Остальные прямоугольники не трогаются
+    first_col, first_row = min(col for col, row in changed), min(row for col, row in changed)
+    last_col, last_row = max(col for col, row in changed), max(row for col, row in changed)
+    kept, cells = list(), set(changed)
+    for rect in rects:
+        col, row, width, height = rect
+        if col > last_col or row > last_row or col + width <= first_col or row + height <= first_row or \
+                not any(col <= c < col + width and row <= r < row + height for c, r in changed):
+            kept.append(rect)
+        else:
+            cells.update((c, r) for c in range(col, col + width) for r in range(row, row + height))
+    patch = bytearray(cols * rows)  # Только эти клетки, чтобы не слить заново нетронутые блоки
+    for col, row in cells:
+        patch[row * cols + col] = tiles[row * cols + col]
+    return kept + merge_solids(patch, cols, rows, cells=cells)
+
+
+def level_update(level):
+    # Правка уже загруженного уровня: текст читается заново и сравнивается с level построчно,
+    # слитые блоки и сущности пересобираются только в изменившихся клетках.
+    # Копия на диске переписывается в фоне - тот, кто ждет уровень (кадр игры), записи не ждет
+    source = source_path(level.name)
+    mtime = os.stat(source).st_mtime_ns
+    with open(source, mode='r') as file:
+        cols, rows, tiles = parse_text(file.read())
+    if (cols, rows) != (level.cols, level.rows):
+        return compile_level(level.name)
+    changed = set()
+    for row in range(rows):
+        start = row * cols
+        if tiles[start:start + cols] != level.tiles[start:start + cols]:
+            changed.update((col, row) for col in range(cols) if tiles[start + col] != level.tiles[start + col])
+    entities, rects = level.entities, level.rects
+    if changed:
+        entities = sorted([entity for entity in entities if (entity[1], entity[2]) not in changed] +
+                          [(SYMBOLS[tiles[row * cols + col]], col, row) for col, row in changed
+                           if tiles[row * cols + col] in ENTITY_TILES], key=lambda entity: (entity[2], entity[1]))
+        rects = rects_patch(tiles, cols, rows, rects, changed)
+    WRITER.submit(lambda: level_save(level.name, encode(mtime, cols, rows, tiles, entities, rects)))
+    return CompiledLevel(level.name, mtime, cols, rows, tiles, entities, rects)
+
+
+def compiled_level_load(name):
+    mtime = os.stat(source_path(name)).st_mtime_ns
+    loaded = LOADED.get(name)
+    if loaded is not None and loaded[0] == mtime:
+        return loaded[1]
+    level = None
+    try:
+        with open(compiled_path(name), mode='rb') as file:
+            data = file.read()
+        if HEADER.unpack_from(data)[2] == mtime:
+            level = decode(name, data)
+    except (OSError, struct.error, ValueError):
+        pass
+    if level is None and loaded is not None:  # Исходник правят во время игры
+        level = level_update(loaded[1])
+    elif level is None:  # Нет копии или исходник изменился
+        level = compile_level(name)
+    LOADED[name] = (mtime, level)
+    return level
+
+
+def main():
+    names = sys.argv[1:] or sorted(name for name in os.listdir(LEVEL_DIR) if name.endswith('.txt'))
+    for name in names:
+        level = compile_level(name)
+        print('{0}: {1}x{2}, блоков слито в {3} прямоугольников, сущностей {4}'.format(
+            name, level.cols, level.rows, len(level.rects), len(level.entities)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import gc
+import os
+import sys
+import threading
+import weakref
+from collections import defaultdict
+
+# Учет памяти под картинки, маски и звуки. Каждый созданный ресурс записывается с происхождением:
+# вид ('surface', 'mask', 'sound'), имя ресурса, место в коде, откуда его запросили, и примерный
+# размер в байтах. Записи держат слабые ссылки, поэтому ресурс пропадает из учета, как только
+# его освободили. Маски слабых ссылок не поддерживают - они живут вместе с владельцем
+# (картинкой или листом кадров), и учитываются, пока жив владелец.
+# Снимок - живые ресурсы по происхождению; разница двух снимков показывает, что не освободилось.
+# Пока учет выключен (enabled = False), track ничего не делает. track зовут и фоновые потоки
+# (сборка соседних уровней, чтение ресурсов при запуске), поэтому записи меняются под замком.
+
+LOADER_FUNCTIONS = frozenset(('track', 'loader', 'image_load', 'sound_load', 'mask_load', 'sheet_load', 'atlas_image',
+                              'effect_play', '<lambda>', '<dictcomp>', '<listcomp>'))  # Место ищется выше них
+LOADER_METHODS = frozenset(('AssetCache.get', 'AssetCache.mask', 'SpriteSheet.__init__', 'AnimatedSprite.__init__'))
+SITE_DEPTH = 12  # Глубже этого места в коде не ищется
+
+
+def resident_bytes():
+    # Сколько памяти процесса сейчас в ОЗУ, или None, если система этого не сообщает
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def call_site():
+    # Первое место в коде выше функций загрузки ресурсов: 'game.py:1411 World.__init__'
+    frame = sys._getframe(2)
+    for depth in range(SITE_DEPTH):
+        if frame is None:
+            break
+        code = frame.f_code
+        if code.co_name not in LOADER_FUNCTIONS and getattr(code, 'co_qualname', None) not in LOADER_METHODS:
+            name = getattr(code, 'co_qualname', code.co_name)
+            return '{0}:{1} {2}'.format(os.path.basename(code.co_filename), frame.f_lineno, name)
+        frame = frame.f_back
+    return '?'
+
+
+class MemoryTracker:
+    def __init__(self):
+        self.enabled = False
+        self.live = dict()  # номер записи -> (слабая ссылка, вид, имя, место, байт)
+        self.count = 0
+        self.created = defaultdict(int)  # (вид, имя, место) -> сколько всего создано
+        self.lock = threading.RLock()  # Слабая ссылка может сработать при сборке мусора прямо под замком
+
+    def track(self, thing, kind, name, size, owner=None):
+        # owner - объект, вместе с которым живет thing (для масок); возвращает thing
+        if not self.enabled:
+            return thing
+        site = call_site()
+        live = self.live
+        lock = self.lock
+        with lock:
+            self.count += 1
+            number = self.count
+
+            def forget(ref):
+                with lock:
+                    live.pop(number, None)
+            ref = weakref.ref(thing if owner is None else owner, forget)
+            live[number] = (ref, kind, str(name), site, size)
+            self.created[(kind, str(name), site)] += 1
+        return thing
+
+    def snapshot(self):
+        # 'origins': {(вид, имя, место): [живых, байт]}, 'totals': память процесса, объекты Python и байты по видам
+        gc.collect()
+        origins = defaultdict(lambda: [0, 0])
+        with self.lock:
+            records = list(self.live.values())
+        for ref, kind, name, site, size in records:
+            if ref() is not None:
+                origins[(kind, name, site)][0] += 1
+                origins[(kind, name, site)][1] += size
+        totals = {'resident': resident_bytes(), 'objects': len(gc.get_objects())}
+        for kind in ('surface', 'mask', 'sound'):
+            totals[kind] = sum(size for key, (count, size) in origins.items() if key[0] == kind)
+        return {'origins': dict(origins), 'totals': totals}
+
+    def stats(self):
+        snapshot = self.snapshot()
+        return dict(snapshot['totals'], live=sum(count for count, size in snapshot['origins'].values()))
+
+
+def snapshot_diff(before, after):
+    # Что прибавилось и убавилось между снимками: [(вид, имя, место, +живых, +байт)], по убыванию байт
+    rows = list()
+    for key in set(before['origins']) | set(after['origins']):
+        old = before['origins'].get(key, (0, 0))
+        new = after['origins'].get(key, (0, 0))
+        if old[0] != new[0] or old[1] != new[1]:
+            rows.append(key + (new[0] - old[0], new[1] - old[1]))
+    rows.sort(key=lambda row: (-abs(row[4]), -abs(row[3]), row[:3]))
+    return rows
+
+
+def diff_report(before, after, limit=10):
+    lines = list()
+    for name in ('resident', 'objects', 'surface', 'mask', 'sound'):
+        old, new = before['totals'].get(name), after['totals'].get(name)
+        if old is not None and new is not None:
+            lines.append('{0:9} {1:>12} {2:+12}'.format(name, new, new - old))
+    for kind, name, site, count, size in snapshot_diff(before, after)[:limit]:
+        lines.append('  {0:7} {1:+5} шт {2:+10} байт  {3}  ({4})'.format(kind, count, size, name, site))
+    return '\n'.join(lines)
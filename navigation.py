@@ -0,0 +1,253 @@
+import heapq
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from level_compiler import SOLID_TILES, TILE_IDS
+
+# Граф навигации врагов по тайлам уровня. Узел (столбец, строка) - место, где враг стоит:
+# его прямоугольник начинается у столбца и стоит на блоке строкой ниже. Ребра - шаг по
+# поверхности, спрыгивание с края и прыжок; спрыгивания и прыжки просчитываются той же
+# физикой, что в Enemy.move (скорость, падение 10 * dy / 100, ускорение 5 до предела -70,
+# прыжок dy = 120 как у игрока). Кратчайшие пути до цели считаются один раз на цель
+# и хранятся таблицей "узел -> (действие, следующий узел)", так что ход врага - поиск в словаре.
+# Каждое ребро помнит клетки, которые смотрела его проверка, поэтому после изменения
+# тайлов пересчитываются только узлы, чьи ребра от этих клеток зависели.
+#
+# Граф строится по областям REGION x REGION тайлов в фоновых потоках: заранее (prepare, поток BUILDER)
+# или когда область понадобилась таблице. Таблицы считаются в потоке PLANNER только по областям
+# рядом с целью (reach), для клеток вокруг новой цели - впрок, пока враги идут к ней. Таблица зависит
+# только от тайлов и цели, поэтому враги ходят одинаково, успели фоновые потоки или нет:
+# если таблицы еще нет, ее ждут.
+
+TILE = 32
+JUMP_DY = 120  # Скорость прыжка, как в Player.jump
+FALL_LIMIT = -70  # Быстрее этого падение не ускоряется
+GRAVITY = 5
+MAX_AIR_STEPS = 240  # Дольше в воздухе - считаем, что враг упал с уровня
+PATH_CACHE = 256  # Сколько целей держать с посчитанными путями
+NAV_SOLID = SOLID_TILES | {TILE_IDS['i']}  # Враги упираются и в ненастоящие блоки
+REGION = 16  # Сторона области графа в тайлах
+NEARBY = ((-2, 2), (-3, 3))  # Клетки вокруг новой цели (столбцы, строки), куда она, скорее всего, пойдет дальше
+
+BUILDER = ThreadPoolExecutor(max_workers=1)  # Строит области графов заранее
+PLANNER = ThreadPoolExecutor(max_workers=1)  # Считает таблицы и перестраивает графы после правок, по очереди
+
+
+def round_half_away(value):
+    # Как pygame.Rect округляет дробные координаты
+    return int(value + 0.5) if value >= 0 else -int(-value + 0.5)
+
+
+class NavGraph:
+    # edges, footprints, watchers и built меняются только в фоновых потоках под lock,
+    # paths и tiles - только в потоке игры
+    def __init__(self, tiles, cols, rows, size=(64, 32), speed=3, reach=None, region=REGION):
+        self.tiles = bytearray(tiles)
+        self.cols = cols
+        self.rows = rows
+        self.width, self.height = size  # Размер врага в пикселях
+        self.span = -(-self.width // TILE)  # Сколько столбцов он занимает
+        self.speed = speed
+        self.reach = reach  # (столбцов, строк) областей вокруг области цели, где ищутся пути; None - весь уровень
+        self.region = region
+        self.edges = dict()  # узел -> [(узел, действие, стоимость в шагах)], действие - (вид, dx)
+        self.footprints = dict()  # узел -> клетки, от которых зависят его ребра
+        self.watchers = dict()  # клетка -> узлы, чьи ребра от нее зависят
+        self.built = set()  # Области (столбец, строка), узлы которых построены
+        self.lock = threading.Lock()
+        self.paths = OrderedDict()  # цель -> Future с таблицей {узел: (действие, следующий узел)}
+        self.last_target = None
+
+    def solid(self, col, row, seen):
+        seen.add((col, row))
+        if col < 0 or col >= self.cols:
+            return True  # Края уровня - стены
+        if row < 0 or row >= self.rows:
+            return False
+        return self.tiles[row * self.cols + col] in NAV_SOLID
+
+    def is_node(self, col, row, seen):
+        # Враг помещается в клетках и хотя бы одной из них есть опора снизу
+        if row < 0 or row >= self.rows - 1 or col < 0 or col + self.span > self.cols:
+            return False
+        cells = range(col, col + self.span)
+        if any(self.solid(c, row, seen) for c in cells):
+            return False
+        return any(self.solid(c, row + 1, seen) for c in cells)
+
+    def overlap(self, x, y, seen):
+        # Занятые клетки под прямоугольником врага: (столбцы, строки)
+        hit_cols, hit_rows = list(), list()
+        for row in range(y // TILE, (y + self.height - 1) // TILE + 1):
+            for col in range(x // TILE, (x + self.width - 1) // TILE + 1):
+                if self.solid(col, row, seen):
+                    hit_cols.append(col)
+                    hit_rows.append(row)
+        return hit_cols, hit_rows
+
+    def simulate(self, node, dx, dy, seen):
+        # Полет врага из узла по правилам Enemy.move. Возвращает (узел приземления, шагов) или None
+        x, y = node[0] * TILE, (node[1] + 1) * TILE - self.height
+        air_time = 0
+        for steps in range(1, MAX_AIR_STEPS):
+            x += dx * self.speed
+            hit_cols, hit_rows = self.overlap(x, y, seen)
+            if hit_cols:  # Уперся в стену - прижимается к ней и летит дальше
+                x = min(hit_cols) * TILE - self.width if dx > 0 else (max(hit_cols) + 1) * TILE
+            y = round_half_away(y - 10 * dy / 100)
+            if dy >= FALL_LIMIT:
+                dy -= GRAVITY
+            hit_cols, hit_rows = self.overlap(x, y, seen)
+            air_time += 1
+            if hit_rows and dy < 0:
+                y = min(hit_rows) * TILE - self.height
+                if air_time > 2:  # Приземлился после падения
+                    return self.landing(x, y, seen), steps
+                dy = 0  # Еще идет по краю, с которого спрыгивает
+                air_time = 0
+            if hit_rows and dy > 0:  # Ударился головой
+                y = (max(hit_rows) + 1) * TILE
+                dy = 0
+            if y >= self.rows * TILE:
+                return None
+        return None
+
+    def landing(self, x, y, seen):
+        row = (y + self.height - 1) // TILE
+        nearest = sorted(range(x // TILE - 1, x // TILE + 2), key=lambda col: abs(col * TILE - x))
+        for col in nearest:
+            if self.is_node(col, row, seen):
+                return col, row
+        return None
+
+    def node_build(self, node):
+        seen = set()
+        edges = list()
+        if self.is_node(node[0], node[1], seen):
+            col, row = node
+            for dx in (-1, 1):
+                if self.is_node(col + dx, row, seen):
+                    edges.append(((col + dx, row), ('walk', dx), TILE / self.speed))
+                elif not any(self.solid(c, row, seen) for c in range(col + dx, col + dx + self.span)):
+                    landed = self.simulate(node, dx, 0, seen)  # Край - спрыгивает
+                    if landed is not None and landed[0] is not None and landed[0] != node:
+                        edges.append((landed[0], ('drop', dx), landed[1]))
+                landed = self.simulate(node, dx, JUMP_DY, seen)
+                if landed is not None and landed[0] is not None and landed[0] != node:
+                    edges.append((landed[0], ('jump', dx), landed[1]))
+            self.edges[node] = edges
+        else:
+            self.edges.pop(node, None)
+        self.footprints[node] = seen
+        for cell in seen:
+            self.watchers.setdefault(cell, set()).add(node)
+
+    def regions_build(self, first_col, first_row, last_col, last_row):
+        # Узлы областей в этих пределах (номера областей, включительно), еще не построенные
+        for key_row in range(max(first_row, 0), min(last_row, (self.rows - 1) // self.region) + 1):
+            for key_col in range(max(first_col, 0), min(last_col, (self.cols - 1) // self.region) + 1):
+                with self.lock:
+                    if (key_col, key_row) in self.built:
+                        continue
+                    for row in range(key_row * self.region, min((key_row + 1) * self.region, self.rows)):
+                        for col in range(key_col * self.region, min((key_col + 1) * self.region, self.cols)):
+                            self.node_build((col, row))
+                    self.built.add((key_col, key_row))
+
+    def prepare(self, col, row, width, height):
+        # Построить в фоне узлы части уровня (в тайлах) - заранее, пока к ним не понадобились пути
+        region = self.region
+        BUILDER.submit(self.regions_build, col // region, row // region,
+                       (col + width - 1) // region, (row + height - 1) // region)
+
+    def update(self, changes):
+        # changes - {(столбец, строка): номер тайла}. Пересчитываются только зависящие от них узлы -
+        # в фоне, перед следующими таблицами; посчитанные таблицы больше не годятся
+        for (col, row), tile_id in changes.items():
+            if 0 <= col < self.cols and 0 <= row < self.rows:
+                self.tiles[row * self.cols + col] = tile_id
+        for future in self.paths.values():
+            future.cancel()
+        self.paths.clear()
+        self.last_target = None
+        PLANNER.submit(self.rebuild, list(changes))
+
+    def rebuild(self, cells):
+        with self.lock:  # Узлы, построенные в это время по старым тайлам, уже записаны в watchers
+            dirty = set()
+            for cell in cells:
+                dirty |= self.watchers.get(cell, set())
+            for node in dirty:
+                for cell in self.footprints.pop(node, ()):
+                    watchers = self.watchers.get(cell)
+                    if watchers is not None:
+                        watchers.discard(node)
+                        if not watchers:
+                            del self.watchers[cell]
+                self.node_build(node)
+
+    def node_at(self, rect):
+        # Узел, на котором стоит прямоугольник (или None, если он в воздухе). Смотрит только тайлы,
+        # поэтому не зависит от того, построены ли уже узлы здесь
+        row = (rect.bottom - 1) // TILE
+        col = (rect.x + TILE // 2) // TILE
+        for candidate in (col, col - 1, col + 1):
+            if self.is_node(candidate, row, set()):
+                return candidate, row
+        return None
+
+    def table(self, target):
+        # Дейкстра от цели по обратным ребрам: для каждого узла - первый шаг к цели.
+        # Только по узлам областей в пределах reach от цели - дальше враги не двигаются (спят в кусках)
+        if self.reach is None:
+            first_col, first_row, last_col, last_row = 0, 0, self.cols // self.region, self.rows // self.region
+        else:
+            key_col, key_row = target[0] // self.region, target[1] // self.region
+            first_col, first_row = key_col - self.reach[0], key_row - self.reach[1]
+            last_col, last_row = key_col + self.reach[0], key_row + self.reach[1]
+        self.regions_build(first_col, first_row, last_col, last_row)
+        left, top = max(first_col, 0) * self.region, max(first_row, 0) * self.region
+        right, bottom = (last_col + 1) * self.region, (last_row + 1) * self.region
+        reverse = dict()  # узел -> [(откуда, действие, стоимость)]
+        for row in range(top, min(bottom, self.rows)):
+            for col in range(left, min(right, self.cols)):
+                for to, action, cost in self.edges.get((col, row), ()):
+                    if left <= to[0] < right and top <= to[1] < bottom:
+                        reverse.setdefault(to, []).append(((col, row), action, cost))
+        distance = {target: 0}
+        found = {target: None}
+        heap = [(0, target)]
+        while heap:
+            spent, node = heapq.heappop(heap)
+            if spent > distance[node]:
+                continue
+            for source, action, cost in reverse.get(node, ()):
+                total = spent + cost
+                if total < distance.get(source, float('inf')):
+                    distance[source] = total
+                    found[source] = (action, node)
+                    heapq.heappush(heap, (total, source))
+        return found
+
+    def request(self, target):
+        # Future с таблицей для цели: уже посчитанной, считающейся или только что заказанной
+        future = self.paths.get(target)
+        if future is not None:
+            self.paths.move_to_end(target)
+            return future
+        future = self.paths[target] = PLANNER.submit(self.table, target)
+        if len(self.paths) > PATH_CACHE:
+            self.paths.popitem(last=False)[1].cancel()
+        return future
+
+    def next_action(self, node, target):
+        # (действие, следующий узел) на пути от node к target; None - пути нет или уже на месте
+        future = self.request(target)
+        if target != self.last_target:  # Цель перешла на новый узел - таблицы для соседних впрок
+            self.last_target = target
+            for row in range(target[1] + NEARBY[1][0], target[1] + NEARBY[1][1] + 1):
+                for col in range(target[0] + NEARBY[0][0], target[0] + NEARBY[0][1] + 1):
+                    if (col, row) not in self.paths and self.is_node(col, row, set()):
+                        self.request((col, row))
+        return future.result().get(node)
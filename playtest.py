@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import sys
+import traceback
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import game
+from benchmark import recorded_trace, scripted_trace
+
+# Прогон уровней без окна сразу на всех ядрах: каждый процесс играет эпизоды случайными
+# (или записанными) нажатиями и считает победы, смерти, шаги до флага и застрявших врагов.
+# У каждого эпизода свое зерно, поэтому любой плохой прогон повторяется через --replay.
+#
+#   python playtest.py --episodes 200 --steps 3000
+#   python playtest.py --levels level3.txt --replay 1000042
+
+STUCK_STEPS = 30  # Сколько шагов подряд враг должен сидеть в стене, чтобы считаться застрявшим
+
+
+def worker_init():
+    game.headless_init()
+
+
+def episode_seed(seed, index):
+    return seed * 1000000 + index
+
+
+def wall_hits(world, enemy):
+    return [block for block in world.blocks.query(enemy.rect)
+            if type(block) in (game.Solid, game.Block) and not block.is_fake and block.rect.colliderect(enemy.rect)]
+
+
+def play_episode(level, seed, steps, trace=None):
+    # Один эпизод: уровень сначала, нажатия по зерну; результат - словарь для отчета
+    inputs = recorded_trace(trace, steps) if trace else scripted_trace(seed, steps)
+    world = game.World(seed=seed, level=level)
+    in_wall = defaultdict(int)  # id врага -> шагов подряд в стене
+    stuck = set()
+    result = {'level': level, 'seed': seed, 'result': 'timeout', 'steps': 0, 'stuck': 0, 'error': None}
+    try:
+        for direction, jump in inputs:
+            status = world.step(direction, jump)
+            for enemy in world.enemies:
+                key = id(enemy)
+                if wall_hits(world, enemy):
+                    in_wall[key] += 1
+                    if in_wall[key] >= STUCK_STEPS:
+                        stuck.add(key)
+                else:
+                    in_wall.pop(key, None)
+            if status is not None:
+                result['result'] = status
+                break
+    except Exception:  # Падение игры - тоже находка, эпизод повторяется по зерну
+        result['result'] = 'error'
+        result['error'] = traceback.format_exc(limit=4)
+    finally:
+        world.close()
+    result['steps'] = world.steps
+    result['stuck'] = len(stuck)
+    return result
+
+
+def play_batch(level, seeds, steps, trace):
+    return [play_episode(level, seed, steps, trace) for seed in seeds]
+
+
+def summarize(results):
+    levels = dict()
+    for result in results:
+        summary = levels.setdefault(result['level'], {'episodes': 0, 'won': 0, 'dead': 0, 'timeout': 0, 'error': 0,
+                                                      'stuck': 0, 'steps_to_flag': list(), 'failures': list()})
+        summary['episodes'] += 1
+        summary[result['result']] += 1
+        summary['stuck'] += result['stuck']
+        if result['result'] == 'won':
+            summary['steps_to_flag'].append(result['steps'])
+        if result['result'] == 'error' or result['stuck']:
+            summary['failures'].append({'seed': result['seed'], 'result': result['result'],
+                                        'stuck': result['stuck'], 'error': result['error']})
+    for summary in levels.values():
+        flag_steps = summary.pop('steps_to_flag')
+        summary['win_rate'] = round(summary['won'] / summary['episodes'], 4)
+        summary['death_rate'] = round(summary['dead'] / summary['episodes'], 4)
+        summary['steps_to_flag'] = ({'min': min(flag_steps), 'mean': round(sum(flag_steps) / len(flag_steps), 1),
+                                     'max': max(flag_steps)} if flag_steps else None)
+    return levels
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Массовый прогон уровней без окна')
+    parser.add_argument('--levels', nargs='*', default=None, help='уровни (по умолчанию все из LEVEL_LIST)')
+    parser.add_argument('--episodes', type=int, default=100, help='эпизодов на уровень')
+    parser.add_argument('--steps', type=int, default=3000, help='предел шагов эпизода')
+    parser.add_argument('--seed', type=int, default=1, help='зерно, из него получаются зерна эпизодов')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch', type=int, default=10, help='эпизодов в одной задаче процесса')
+    parser.add_argument('--trace', default=None, help='JSON с записанными нажатиями вместо случайных')
+    parser.add_argument('--replay', type=int, default=None, help='повторить один эпизод с этим зерном')
+    parser.add_argument('--require-win', action='store_true', help='ошибка, если уровень ни разу не пройден')
+    parser.add_argument('--output', default='playtest_results.json')
+    args = parser.parse_args(argv)
+    levels = args.levels or game.LEVEL_LIST
+
+    if args.replay is not None:
+        worker_init()
+        for level in levels:
+            result = play_episode(level, args.replay, args.steps, args.trace)
+            print(json.dumps(result, ensure_ascii=False, indent=2))
+        return 0
+
+    tasks = list()
+    for level in levels:
+        seeds = [episode_seed(args.seed, index) for index in range(args.episodes)]
+        for start in range(0, len(seeds), args.batch):
+            tasks.append((level, seeds[start:start + args.batch]))
+    results = list()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=worker_init) as executor:
+        futures = [executor.submit(play_batch, level, seeds, args.steps, args.trace) for level, seeds in tasks]
+        for future in futures:
+            results.extend(future.result())
+
+    levels_summary = summarize(results)
+    failed = False
+    for level, summary in levels_summary.items():
+        print('{0:16} побед {1:6.1%}  смертей {2:6.1%}  застряло врагов {3:4}  ошибок {4:4}'.format(
+            level, summary['win_rate'], summary['death_rate'], summary['stuck'], summary['error']))
+        for failure in summary['failures'][:5]:
+            print('    повторить: python playtest.py --levels {0} --replay {1} --steps {2}'.format(
+                level, failure['seed'], args.steps))
+        if summary['failures'] or (args.require_win and summary['won'] == 0):
+            failed = True
+    report = {'meta': {'episodes': args.episodes, 'steps': args.steps, 'seed': args.seed, 'trace': args.trace,
+                       'workers': args.workers},
+              'levels': levels_summary}
+    with open(args.output, mode='w') as file:
+        json.dump(report, file, indent=2, ensure_ascii=False)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+import json
+import struct
+import zlib
+from bisect import bisect_right
+
+# Запись сессии: нажатия игрока по шагам физики и снимки мира, чтобы повторить игру точно.
+# Нажатия на шаге - три бита (влево, вправо, прыжок); пишется только их смена: запись 'I',
+# сколько шагов прошло с прошлой смены и новые биты. Враги уровня зависят только от зерна мира
+# и имени уровня, поэтому зерна в заголовке хватает, чтобы повторить все с нулевого шага.
+# Раз в snapshot_steps шагов пишется снимок мира 'S' (World.snapshot, JSON в zlib) - с ближайшего
+# снимка повтор можно начать, не проигрывая час игры с начала. В конце - 'E' и число шагов.
+#
+#   JREC, версия, зерно, шагов физики в секунду, рой, шагов между снимками, имя уровня,
+#   потом записи: I <шагов с прошлой смены> <биты> | S <шаг> <длина> <снимок> | E <шагов всего>
+
+MAGIC = b'JREC'
+VERSION = 1
+HEADER = struct.Struct('<4sHqHBIH')  # метка, версия, зерно, шагов в секунду, рой, шагов между снимками, длина имени
+SNAPSHOT_STEPS = 600  # Снимок раз в 10 секунд при 60 шагах в секунду
+LEFT, RIGHT, JUMP = 1, 2, 4
+INPUT, SNAPSHOT, END = b'I', b'S', b'E'
+
+
+def varint(value):
+    # Целое без знака по 7 бит в байте, младшие вперед: до 127 - один байт
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def varint_read(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def input_bits(direction, jump):
+    return (LEFT if 'left' in direction else 0) | (RIGHT if 'right' in direction else 0) | (JUMP if jump else 0)
+
+
+def input_decode(bits):
+    direction = list()
+    if bits & LEFT:
+        direction.append('left')
+    if bits & RIGHT:
+        direction.append('right')
+    return direction, bool(bits & JUMP)
+
+
+class Recorder:
+    # record вызывается перед каждым шагом мира с теми нажатиями, с которыми он будет сделан
+    def __init__(self, path, world, physics_rate, swarm=False, snapshot_steps=SNAPSHOT_STEPS):
+        self.world = world
+        self.snapshot_steps = snapshot_steps
+        self.bits = 0  # Нажатия после последней смены
+        self.changed = 0  # Шаг последней смены
+        self.file = open(path, mode='wb')
+        level = world.level_scene.name.encode('utf-8')
+        self.file.write(HEADER.pack(MAGIC, VERSION, world.seed, physics_rate, swarm, snapshot_steps, len(level)))
+        self.file.write(level)
+
+    def record(self, direction, jump):
+        steps = self.world.steps
+        if steps and steps % self.snapshot_steps == 0:
+            snapshot = self.world.snapshot()
+            if snapshot is not None:  # На уровнях, которые не сохраняются, снимок пропускается
+                payload = zlib.compress(json.dumps(snapshot, separators=(',', ':')).encode('utf-8'))
+                self.file.write(SNAPSHOT + varint(steps) + varint(len(payload)) + payload)
+        bits = input_bits(direction, jump)
+        if bits != self.bits:
+            self.file.write(INPUT + varint(steps - self.changed) + bytes((bits,)))
+            self.bits = bits
+            self.changed = steps
+
+    def close(self):
+        if self.file is not None:
+            self.file.write(END + varint(self.world.steps))
+            self.file.close()
+            self.file = None
+
+
+class Recording:
+    # Файл записи, прочитанный целиком: смены нажатий и положения снимков в нем (для поиска по шагу)
+    def __init__(self, path):
+        with open(path, mode='rb') as file:
+            data = file.read()
+        magic, version, self.seed, self.physics_rate, swarm, self.snapshot_steps, length = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{0}: не файл записи или другой версии'.format(path))
+        self.swarm = bool(swarm)
+        pos = HEADER.size
+        self.level = data[pos:pos + length].decode('utf-8')
+        pos += length
+        self.data = data
+        self.change_steps = [0]  # С какого шага действуют нажатия change_bits того же номера
+        self.change_bits = [0]
+        self.snapshot_steps_list = list()  # Шаги снимков по возрастанию
+        self.snapshot_places = list()  # (начало, конец) сжатого снимка в data
+        self.steps = None  # Шагов всего; None - запись оборвана (игра закрылась без close)
+        try:
+            while pos < len(data):
+                kind = data[pos:pos + 1]
+                if kind == INPUT:
+                    delta, pos = varint_read(data, pos + 1)
+                    self.change_steps.append(self.change_steps[-1] + delta)
+                    self.change_bits.append(data[pos])
+                    pos += 1
+                elif kind == SNAPSHOT:
+                    step, pos = varint_read(data, pos + 1)
+                    length, pos = varint_read(data, pos)
+                    if pos + length > len(data):
+                        break
+                    self.snapshot_steps_list.append(step)
+                    self.snapshot_places.append((pos, pos + length))
+                    pos += length
+                elif kind == END:
+                    self.steps, pos = varint_read(data, pos + 1)
+                    break
+                else:
+                    raise ValueError('{0}: испорченная запись на байте {1}'.format(path, pos))
+        except IndexError:  # Оборванная последняя запись
+            pass
+        if self.steps is None:
+            self.steps = max(self.change_steps[-1], self.snapshot_steps_list[-1] if self.snapshot_steps_list else 0)
+
+    def bits_at(self, step):
+        return self.change_bits[bisect_right(self.change_steps, step) - 1]
+
+    def inputs(self, start=0, stop=None):
+        # (направление, прыжок) для шагов start..stop-1
+        stop = self.steps if stop is None else stop
+        index = bisect_right(self.change_steps, start) - 1
+        for step in range(start, stop):
+            while index + 1 < len(self.change_steps) and self.change_steps[index + 1] <= step:
+                index += 1
+            yield input_decode(self.change_bits[index])
+
+    def snapshot_before(self, step):
+        # Номер последнего снимка не позже step или None
+        index = bisect_right(self.snapshot_steps_list, step) - 1
+        return index if index >= 0 else None
+
+    def snapshot(self, index):
+        start, end = self.snapshot_places[index]
+        return json.loads(zlib.decompress(self.data[start:end]).decode('utf-8'))
@@ -0,0 +1,108 @@
+import argparse
+import json
+import sys
+from time import perf_counter
+
+import pygame
+
+import game
+from recording import Recording
+
+# Повтор записанной сессии (game.py --record). Без ключей запись проигрывается без окна от начала
+# до конца, и на каждом снимке состояние мира сверяется с записанным - так видно, повторяется ли
+# игра точно. --seek переходит к любому шагу: мир восстанавливается из ближайшего снимка до него
+# и дальше считается по записанным нажатиям. --show показывает повтор в окне с этого шага.
+#
+#   python replay.py session.jrec
+#   python replay.py session.jrec --seek 150000
+#   python replay.py session.jrec --seek 150000 --show
+
+
+def world_at(recording, step):
+    # Мир на шаге step: с ближайшего снимка, а не с нулевого шага
+    world = game.World(seed=recording.seed, level=recording.level, scene_cache=game.SceneCache(),
+                       swarm=recording.swarm, physics_rate=recording.physics_rate)
+    index = recording.snapshot_before(step)
+    if index is not None:
+        world.restore(recording.snapshot(index))
+    for direction, jump in recording.inputs(world.steps, step):
+        if world.step(direction, jump) is not None:
+            break
+    return world
+
+
+def verify(recording):
+    # Проигрывает всю запись; возвращает (сверено снимков, шаг первого расхождения или None)
+    world = world_at(recording, 0)
+    checked = 0
+    for index, step in enumerate(recording.snapshot_steps_list):
+        for direction, jump in recording.inputs(world.steps, step):
+            world.step(direction, jump)
+        snapshot = world.snapshot()
+        if snapshot is None or json.loads(json.dumps(snapshot)) != recording.snapshot(index):
+            world.close()
+            return checked, step
+        checked += 1
+    for direction, jump in recording.inputs(world.steps):
+        world.step(direction, jump)
+    world.close()
+    return checked, None
+
+
+def show(recording, world):
+    # Повтор в окне со скоростью игры; Esc или закрытие окна - выход
+    canvas = pygame.display.get_surface()
+    clock = pygame.time.Clock()
+    world.draw(canvas, True)
+    pygame.display.flip()
+    for direction, jump in recording.inputs(world.steps):
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+                return
+        status = world.step(direction, jump)
+        pygame.display.update(world.draw(canvas))
+        clock.tick(recording.physics_rate)
+        if status is not None:
+            break
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Повтор записанной сессии')
+    parser.add_argument('path', help='файл записи (game.py --record)')
+    parser.add_argument('--seek', type=int, default=None, help='перейти к шагу')
+    parser.add_argument('--show', action='store_true', help='показать повтор в окне')
+    args = parser.parse_args(argv)
+    recording = Recording(args.path)
+    print('{0}: уровень {1}, зерно {2}, шагов {3} ({4:.0f} с), снимков {5}'.format(
+        args.path, recording.level, recording.seed, recording.steps, recording.steps / recording.physics_rate,
+        len(recording.snapshot_steps_list)))
+
+    if args.show:
+        pygame.init()
+        pygame.display.set_caption('повтор')
+        pygame.display.set_mode(game.SIZE)
+    else:
+        game.headless_init()
+    if args.seek is None and not args.show:
+        started = perf_counter()
+        checked, diverged = verify(recording)
+        print('сверено снимков {0} за {1:.1f} с'.format(checked, perf_counter() - started))
+        if diverged is not None:
+            print('расхождение на шаге {0}'.format(diverged))
+            return 1
+        return 0
+
+    started = perf_counter()
+    world = world_at(recording, args.seek or 0)
+    jod = world.jod
+    print('шаг {0} за {1:.0f} мс: {2}, игрок {3}, dy {4}, врагов {5}'.format(
+        world.steps, (perf_counter() - started) * 1000, world.level_scene.name, tuple(jod.rect), jod.dy,
+        len(world.enemies)))
+    if args.show:
+        show(recording, world)
+    world.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
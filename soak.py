@@ -0,0 +1,143 @@
+import argparse
+import ctypes
+import gc
+import json
+import sys
+from concurrent.futures import wait
+from time import perf_counter
+
+import pygame
+
+import game
+from memory import diff_report, resident_bytes, snapshot_diff
+
+# Долгий прогон без окна для поиска утечек: по кругу экран смерти, повтор (новый мир с первого
+# уровня), спуск по всем уровням и подъем обратно, меню. После разогрева снимается память,
+# дальше после каждого круга запоминается, сколько процесс занимает в ОЗУ.
+# Ошибка, если в конце живых картинок, масок или звуков больше, чем после разогрева,
+# или память процесса растет больше допуска. Автоматы в залах работают сутками без перезапуска.
+#
+#   python soak.py --cycles 2000
+#   python soak.py --cycles 200 --output soak.json
+
+MB = 1024 * 1024
+try:  # glibc держит освобожденную память у себя; malloc_trim отдает ее системе перед замером
+    MALLOC_TRIM = ctypes.CDLL('libc.so.6').malloc_trim
+except (OSError, AttributeError):
+    MALLOC_TRIM = None
+
+
+def floor_growth(residents):
+    # Даже в покое память процесса скачет (освобожденное не сразу возвращается системе),
+    # поэтому сравниваются нижние значения первой и второй половины прогона: утечка поднимает дно
+    half = len(residents) // 2
+    if half == 0 or None in residents:
+        return None
+    return (min(residents[half:]) - min(residents[:half])) / MB
+
+
+def soak_game():
+    game.headless_init()
+    try:  # Звуки загружаются по-настоящему через пустой аудиодрайвер, хоть и не слышны
+        pygame.mixer.init()
+        game.MUTED = False
+    except pygame.error:
+        pass
+    canvas = pygame.display.get_surface()
+    profiler = game.Profiler(overlay=True)  # Таблица тоже пересоздается, как при F3
+    return game.Game(canvas, game.Renderer(canvas), profiler)
+
+
+def settle(app):
+    # Память процесса меряется, когда фоновые сборки соседних уровней закончены и мусор собран,
+    # иначе замер попадает то на середину сборки, то после нее
+    if app.world.prefetcher is not None:
+        wait(list(app.world.prefetcher.futures.values()))
+    gc.collect()
+    if MALLOC_TRIM is not None:
+        MALLOC_TRIM(0)
+    return resident_bytes()
+
+
+def soak_cycle(app, steps):
+    # Один круг тех же переходов, что делает игрок: смерть, повтор, все уровни вниз и вверх, меню
+    death = app.states['death']
+    death.enter()
+    death.group.draw(app.canvas)
+    retry = next(button for button, action in death.buttons if action == 'retry')
+    death.click(retry.rect.center)
+    app.states['playing'].enter()
+    world = app.world
+    for name in game.LEVEL_LIST + game.LEVEL_LIST[-2::-1]:
+        world.load_level(name)
+        world.draw(app.canvas, True)
+        for step in range(steps):
+            world.step(['right'], step == 0)
+            app.profiler.end_frame()
+        app.profiler.draw(app.canvas)
+    world.jod.die()
+    menu = app.states['menu']
+    menu.enter()
+    menu.group.draw(app.canvas)
+    game.audio_stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Поиск утечек памяти долгим прогоном без окна')
+    parser.add_argument('--cycles', type=int, default=1000, help='кругов после разогрева')
+    parser.add_argument('--warmup', type=int, default=20, help='кругов до первого снимка памяти')
+    parser.add_argument('--steps', type=int, default=30, help='шагов физики на каждом уровне круга')
+    parser.add_argument('--checks', type=int, default=10, help='сколько раз за прогон замерять память процесса')
+    parser.add_argument('--tolerance', type=float, default=16, help='допустимый рост памяти процесса, МБ')
+    parser.add_argument('--output', default=None, help='JSON с замерами')
+    args = parser.parse_args(argv)
+
+    game.MEMORY.enabled = True
+    app = soak_game()
+    for cycle in range(args.warmup):
+        soak_cycle(app, args.steps)
+    start = game.MEMORY.snapshot()
+    every = max(args.cycles // max(args.checks, 1), 1)
+    residents = list()  # Память процесса после каждого круга
+    checkpoints = list()
+    began = perf_counter()
+    for cycle in range(1, args.cycles + 1):
+        soak_cycle(app, args.steps)
+        residents.append(settle(app))
+        if cycle % every == 0 or cycle == args.cycles:
+            window = [value for value in residents[-every:] if value is not None]
+            checkpoint = {'cycle': cycle, 'seconds': round(perf_counter() - began, 1),
+                          'min': min(window, default=None), 'max': max(window, default=None)}
+            checkpoints.append(checkpoint)
+            print('круг {0:6}  {1:6.1f} с  память {2}'.format(cycle, checkpoint['seconds'], '?' if not window else
+                                                             '{0:.1f}-{1:.1f} МБ'.format(min(window) / MB,
+                                                                                         max(window) / MB)))
+    end = game.MEMORY.snapshot()
+    app.world.close()
+
+    print(diff_report(start, end))
+    failures = list()
+    for kind, name, site, count, size in snapshot_diff(start, end):
+        if count > 0:
+            failures.append('{0} {1} ({2}): не освобождено {3} шт, {4} байт'.format(kind, name, site, count, size))
+    growth = floor_growth(residents)
+    if growth is not None and growth > args.tolerance:
+        failures.append('память процесса выросла на {0:.1f} МБ за {1} кругов (допуск {2} МБ)'.format(
+            growth, args.cycles, args.tolerance))
+    for failure in failures:
+        print(failure)
+    if not failures:
+        print('утечек нет: {0} кругов, рост памяти {1}'.format(
+            args.cycles, '?' if growth is None else '{0:.1f} МБ'.format(growth)))
+    if args.output is not None:
+        report = {'meta': {'cycles': args.cycles, 'warmup': args.warmup, 'steps': args.steps,
+                           'tolerance_mb': args.tolerance},
+                  'checkpoints': checkpoints, 'failures': failures,
+                  'diff': [list(row) for row in snapshot_diff(start, end)]}
+        with open(args.output, mode='w') as file:
+            json.dump(report, file, indent=2, ensure_ascii=False)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
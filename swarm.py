@@ -0,0 +1,124 @@
+import numpy as np
+
+# Враги как структура массивов: все координаты, скорости, dy, время в воздухе и направление
+# лежат в массивах NumPy, и шаг физики делается сразу для всех врагов операциями над массивами
+# по карте занятых клеток уровня. Правила те же, что в Enemy.move: ходьба в сторону direction,
+# разворот у стены, падение с ускорением до предела и остановка на опоре.
+
+TILE = 32
+
+
+def round_half_away(values):
+    # pygame.Rect округляет дробные координаты до ближайшего целого, половину - от нуля
+    return np.trunc(values + np.copysign(0.5, values)).astype(np.int64)
+
+
+def shift(values, amount, carry, scale):
+    # Как Entity.shift: на шагах не обычной длины дробный остаток копится в carry
+    if scale == 1:
+        return round_half_away(values + amount), carry
+    carry = carry + amount
+    whole = np.trunc(carry)
+    return values + whole.astype(np.int64), carry - whole
+
+
+class EnemySwarm:
+    def __init__(self, rects, facing, obstacles, cols, rows, speed=3):
+        # rects - (x, y, ширина, высота) врагов, facing - 1 вправо или -1 влево,
+        # obstacles - прямоугольники, о которые враги спотыкаются, cols x rows - размер уровня в клетках
+        rects = np.array(rects, dtype=np.int64).reshape(-1, 4)
+        self.x = rects[:, 0].copy()
+        self.y = rects[:, 1].copy()
+        self.w = rects[:, 2].copy()
+        self.h = rects[:, 3].copy()
+        self.facing = np.array(facing, dtype=np.int64).reshape(-1)
+        self.dx = self.facing.copy()
+        self.dy = np.zeros(len(self.x), dtype=np.float64)
+        self.air_time = np.zeros(len(self.x), dtype=np.int64)
+        self.carry_x = np.zeros(len(self.x))
+        self.carry_y = np.zeros(len(self.x))
+        self.speed = speed
+        self.solid = np.zeros((rows, cols), dtype=bool)
+        for left, top, width, height in obstacles:
+            self.solid[max(top // TILE, 0):max((top + height - 1) // TILE + 1, 0),
+                       max(left // TILE, 0):max((left + width - 1) // TILE + 1, 0)] = True
+        self.steps = dict()  # (столбцов, строк) -> смещения клеток, которые задевает такой прямоугольник
+        self.start = self.state()
+        self.previous = None  # (x, y) до последнего шага - для плавной отрисовки, задается снаружи
+
+    def __len__(self):
+        return len(self.x)
+
+    def state(self):
+        return tuple(array.copy() for array in (self.x, self.y, self.facing, self.dx, self.dy, self.air_time))
+
+    def restore(self, state):
+        self.x, self.y, self.facing, self.dx, self.dy, self.air_time = (array.copy() for array in state)
+
+    def reset(self):
+        self.restore(self.start)
+        self.carry_x = np.zeros(len(self.x))
+        self.carry_y = np.zeros(len(self.x))
+        self.previous = None
+
+    def cell_steps(self, width, height):
+        # Прямоугольник не шире width и не выше height задевает не больше span_cols x span_rows клеток
+        span_cols = int((width + TILE - 2) // TILE + 1)
+        span_rows = int((height + TILE - 2) // TILE + 1)
+        if (span_cols, span_rows) not in self.steps:
+            self.steps[span_cols, span_rows] = (np.repeat(np.arange(span_cols), span_rows)[None, :],
+                                                np.tile(np.arange(span_rows), span_cols)[None, :])
+        return self.steps[span_cols, span_rows]
+
+    def overlap(self, x, y, w, h):
+        # Для каждого прямоугольника (x, y, w, h): задевает ли занятые клетки,
+        # и самые левый/правый столбцы и верхняя строка среди них
+        rows, cols = self.solid.shape
+        col_steps, row_steps = self.cell_steps(w.max(initial=1), h.max(initial=1))
+        first_col = (x // TILE)[:, None]
+        first_row = (y // TILE)[:, None]
+        last_col = ((x + w - 1) // TILE)[:, None]
+        last_row = ((y + h - 1) // TILE)[:, None]
+        col = first_col + col_steps  # Клетки под прямоугольником: по столбцу на каждую пару смещений
+        row = first_row + row_steps
+        inside = (col <= last_col) & (row <= last_row) & (col >= 0) & (col < cols) & (row >= 0) & (row < rows)
+        occupied = inside & self.solid[np.clip(row, 0, rows - 1), np.clip(col, 0, cols - 1)]
+        hit = occupied.any(axis=1)
+        min_col = np.where(occupied, col, cols).min(axis=1, initial=cols)
+        max_col = np.where(occupied, col, -1).max(axis=1, initial=-1)
+        min_row = np.where(occupied, row, rows).min(axis=1, initial=rows)
+        return hit, min_col, max_col, min_row
+
+    def step(self, scale=1):
+        # scale - во сколько раз шаг длиннее обычного (как в Enemy.move).
+        # Клетки проверяются по всему пути за шаг, по каждой оси отдельно: на длинном шаге враг
+        # иначе перескочил бы стену или пол в одну клетку (как swept-проверка в collide_detect)
+        self.dx = self.facing.copy()
+        start = self.x
+        self.x, self.carry_x = shift(self.x, self.dx * self.speed * scale, self.carry_x, scale)
+        left_edge = np.minimum(start, self.x)
+        hit, min_col, max_col, min_row = self.overlap(left_edge, self.y, np.maximum(start, self.x) - left_edge + self.w,
+                                                      self.h)
+        right = hit & (self.dx > 0)
+        left = hit & (self.dx < 0)
+        self.x = np.where(right, min_col * TILE - self.w, self.x)  # Уперся справа - разворот влево
+        self.x = np.where(left, (max_col + 1) * TILE, self.x)
+        self.facing = np.where(right, -1, np.where(left, 1, self.facing))
+
+        start = self.y
+        self.y, self.carry_y = shift(self.y, -10 * self.dy / 100 * scale, self.carry_y, scale)  # Падение
+        self.dy = np.where(self.dy >= -70, self.dy - 5 * scale, self.dy)  # Ускорение падения до предела
+        self.air_time += 1
+        top_edge = np.minimum(start, self.y)
+        hit, min_col, max_col, min_row = self.overlap(self.x, top_edge, self.w,
+                                                      np.maximum(start, self.y) - top_edge + self.h)
+        landed = hit & (self.dy < 0)
+        self.y = np.where(landed, min_row * TILE - self.h, self.y)
+        self.dy = np.where(landed, 0, self.dy)
+        self.air_time = np.where(landed, 0, self.air_time)
+
+    def touching(self, rect):
+        # Номера врагов, чьи прямоугольники пересекаются с rect
+        left, top, width, height = rect
+        return np.flatnonzero((self.x < left + width) & (self.x + self.w > left) &
+                              (self.y < top + height) & (self.y + self.h > top))